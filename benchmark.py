@@ -0,0 +1,207 @@
+"""Benchmarks of the field computation and scene construction
+
+Records the best wall time over a few repeats, the peak memory allocated
+during a run (through `tracemalloc`, which numpy reports its arrays to) and
+the throughput in grid points per second, and writes everything to a JSON
+file so that runs on different commits or machines can be compared::
+
+    python benchmark.py -o before.json
+    python benchmark.py -o after.json --compare before.json
+
+The scene construction benchmark needs Mayavi and renders offscreen, it is
+skipped when Mayavi cannot be imported.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Callable, List, Optional, Sequence
+import numpy as np
+import scipy
+
+import field_compute as fc
+
+
+def measure(fn: Callable[[], object], repeat: int = 3) -> dict:
+    """Best and mean wall time of `fn` and the peak memory of one call"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    # Memory is measured in a separate run as tracing slows allocations down
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"time_s": min(times), "mean_s": float(np.mean(times)), "peak_bytes": peak}
+
+
+def record(results: list, name: str, points: int, stats: dict, **params) -> None:
+    stats["points_per_s"] = points / stats["time_s"] if stats["time_s"] else None
+    results.append({"name": name, "params": params, "points": points, **stats})
+    print(
+        f"{name:<16} {json.dumps(params):<52} {stats['time_s'] * 1e3:10.2f} ms"
+        f" {stats['peak_bytes'] / 2 ** 20:10.1f} MB"
+        f" {stats['points_per_s'] / 1e6:8.2f} Mpts/s"
+    )
+
+
+def bench_grid(results: list, resolutions: Sequence[int], repeat: int) -> None:
+    for n in resolutions:
+        grid = fc.Grid.for_radius(1.0, n * 1j)
+        for mat_type in ("sparse", "dense"):
+            stats = measure(lambda: grid.get_grid(mat_type), repeat)
+            record(results, "get_grid", n ** 3, stats, n=n, mat_type=mat_type)
+
+
+def bench_single_coil(results: list, resolutions: Sequence[int], repeat: int) -> None:
+    coil = fc.Coil(1.0, 1.0)
+    backends = {
+        "reference": lambda x, y, z: fc.magnetic_field_single_coil(x, y, z, 1.0, 1.0),
+        "fused": lambda x, y, z: fc.CoilSet([coil]).field(x, y, z),
+        "fused-agm": lambda x, y, z: fc.CoilSet([coil], "agm").field(x, y, z),
+        "table": lambda x, y, z: fc.magnetic_field_single_coil_table(
+            x, y, z, 1.0, 1.0
+        ),
+    }
+    for n in resolutions:
+        x, y, z = fc.Grid.for_radius(1.0, n * 1j).get_grid("sparse")
+        for backend, kernel in backends.items():
+            stats = measure(lambda: kernel(x, y, z), repeat)
+            record(results, "single_coil", n ** 3, stats, n=n, backend=backend)
+
+
+def bench_compute_field(
+    results: list, resolutions: Sequence[int], coil_counts: Sequence[int], repeat: int
+) -> None:
+    options = {
+        "direct": {},
+        "agm": {"elliptic": "agm"},
+        "symmetry": {"symmetry": True},
+        "float32": {"dtype": np.float32},
+        "slabs-64MB": {"memory_limit": 64 * 2 ** 20},
+        "threads": {"workers": None},
+    }
+    for n in resolutions:
+        grid = fc.Grid.for_radius(1.0, n * 1j)
+        for count in coil_counts:
+            coils = fc.helmholtz(1.0, 1.0, pairs=max(1, count // 2))
+            for backend, kwargs in options.items():
+                stats = measure(lambda: fc.compute_field(coils, grid, **kwargs), repeat)
+                record(
+                    results,
+                    "compute_field",
+                    n ** 3,
+                    stats,
+                    n=n,
+                    coils=len(coils),
+                    backend=backend,
+                )
+
+
+def bench_scene(results: list, resolutions: Sequence[int], repeat: int) -> None:
+    try:
+        from mayavi import mlab
+        from magnetic_field import MagneticField
+    except ImportError as e:
+        print(f"scene_setup      skipped: {e}")
+        return
+    mlab.options.offscreen = True
+
+    for n in resolutions:
+        plot = MagneticField(1.0, 1.0, spacing=n * 1j)
+        B = fc.compute_field(
+            fc.coil_pair(1.0, 1.0),
+            plot.grid,
+            out=fc.point_order_field(plot.grid.shape),
+        )
+
+        def scene():
+            mlab.clf()
+            plot.scene_setup(B, seedtype="sphere")
+
+        mlab.figure(1, size=(800, 600))
+        stats = measure(scene, repeat)
+        record(results, "scene_setup", n ** 3, stats, n=n)
+        mlab.close(all=True)
+
+
+def compare(results: List[dict], baseline: List[dict]) -> None:
+    """Print the speed-up of every benchmark present in both runs"""
+    key = lambda r: (r["name"], json.dumps(r["params"], sort_keys=True))
+    old = {key(r): r for r in baseline}
+    print(f"\n{'benchmark':<70} {'speed-up':>9} {'memory':>9}")
+    for r in results:
+        b = old.get(key(r))
+        if b is None:
+            continue
+        print(
+            f"{r['name'] + ' ' + json.dumps(r['params']):<70}"
+            f" {b['time_s'] / r['time_s']:8.2f}x"
+            f" {r['peak_bytes'] / max(b['peak_bytes'], 1):8.2f}x"
+        )
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--resolutions",
+        type=int,
+        nargs="+",
+        default=[25, 50, 100],
+        help="grid points per axis",
+    )
+    parser.add_argument(
+        "--coils",
+        type=int,
+        nargs="+",
+        default=[2, 8],
+        help="coil counts for compute_field",
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per case")
+    parser.add_argument(
+        "--only",
+        nargs="+",
+        choices=("grid", "single_coil", "compute_field", "scene"),
+        default=("grid", "single_coil", "compute_field", "scene"),
+    )
+    parser.add_argument("-o", "--output", default="benchmark.json")
+    parser.add_argument("--compare", metavar="JSON", help="baseline results")
+    args = parser.parse_args(argv)
+
+    results = []
+    if "grid" in args.only:
+        bench_grid(results, args.resolutions, args.repeat)
+    if "single_coil" in args.only:
+        bench_single_coil(results, args.resolutions, args.repeat)
+    if "compute_field" in args.only:
+        bench_compute_field(results, args.resolutions, args.coils, args.repeat)
+    if "scene" in args.only:
+        bench_scene(results, args.resolutions, args.repeat)
+
+    meta = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+    with open(args.output, "w") as f:
+        json.dump({"meta": meta, "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Complete elliptic integrals via the arithmetic-geometric mean
+
+`scipy.special.ellipk` and `scipy.special.ellipe` each evaluate their own
+polynomial approximation. Both integrals can instead be obtained from a
+single AGM iteration (Abramowitz & Stegun 17.6)::
+
+    a_0 = 1, b_0 = sqrt(1 - m), c_0 = sqrt(m)
+    a_{n+1} = (a_n + b_n) / 2, b_{n+1} = sqrt(a_n b_n), c_{n+1} = (a_n - b_n) / 2
+    K(m) = pi / (2 a_N),  E(m) = K(m) (1 - sum_n 2^(n-1) c_n^2)
+
+which converges quadratically, so a handful of iterations reach machine
+precision. Run `python elliptic.py` to check the accuracy against SciPy, it
+exits with an error if any relative error exceeds `TOLERANCE` eps.
+"""
+from typing import Optional, Tuple
+import numpy as np
+
+# Largest relative error against SciPy accepted by the accuracy check, in
+# units of the machine epsilon of the evaluated precision
+TOLERANCE = 64
+
+
+def agm_iterations(m_max: float, dtype=np.float64, max_iterations: int = 16) -> int:
+    """Number of AGM iterations needed for full precision up to `m_max`
+
+    The AGM converges slowest for the largest parameter, so the iteration
+    count needed by `m_max` is enough for every smaller m.
+
+    Args:
+        m_max (float): largest parameter m that will be evaluated
+        dtype (optional): precision to converge to. Defaults to np.float64.
+        max_iterations (int, optional): cap for m -> 1 where K diverges.
+            Defaults to 16.
+
+    Returns:
+        int: iteration count
+    """
+    eps = np.finfo(dtype).eps
+    a, b = 1.0, np.sqrt(max(1.0 - float(m_max), 0.0))
+    for n in range(1, max_iterations + 1):
+        a, b, c = (a + b) / 2, np.sqrt(a * b), (a - b) / 2
+        if c <= eps * a:
+            return n
+    return max_iterations
+
+
+def ellipke(
+    m: np.ndarray,
+    K: Optional[np.ndarray] = None,
+    E: Optional[np.ndarray] = None,
+    iterations: Optional[int] = None,
+    block: int = 32768,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Complete elliptic integrals of the first and second kind together
+
+    Same conventions as `scipy.special.ellipk` and `scipy.special.ellipe`,
+    i.e. in terms of the parameter m = k^2, for 0 <= m <= 1. The iteration
+    runs over cache-sized blocks so the repeated passes of the AGM stay in
+    cache instead of streaming full arrays through memory.
+
+    Args:
+        m (np.ndarray): parameter, must be C-contiguous
+        K (np.ndarray, optional): C-contiguous output for K, may not alias
+            `m`. Defaults to a new array.
+        E (np.ndarray, optional): C-contiguous output for E, may alias `m`.
+            Defaults to a new array.
+        iterations (int, optional): fixed AGM iteration count. Defaults to
+            `agm_iterations` of the largest m.
+        block (int, optional): elements per block. Defaults to 32768.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: K, E
+    """
+    m = np.asarray(m)
+    if K is None:
+        K = np.empty_like(m)
+    if E is None:
+        E = np.empty_like(m)
+    for arr in (m, K, E):
+        if not arr.flags.c_contiguous:
+            raise ValueError("ellipke requires C-contiguous arrays")
+    if iterations is None:
+        iterations = agm_iterations(m.max(initial=0), m.dtype)
+
+    m_flat, K_flat, E_flat = m.reshape(-1), K.reshape(-1), E.reshape(-1)
+    a, b, s, c = np.empty((4, min(block, m.size)), dtype=m.dtype)
+    for i in range(0, m.size, block):
+        n = min(block, m.size - i)
+        mi, ai, bi, si, ci = m_flat[i : i + n], a[:n], b[:n], s[:n], c[:n]
+
+        ai.fill(1)
+        np.subtract(1, mi, out=bi)
+        np.maximum(bi, 0, out=bi)
+        np.sqrt(bi, out=bi)
+        np.multiply(mi, 0.5, out=si)
+        weight = 0.5
+        for _ in range(iterations):
+            # c = (a - b) / 2, b = sqrt(a b), a = (a + b) / 2 = a - c
+            np.subtract(ai, bi, out=ci)
+            ci *= 0.5
+            bi *= ai
+            np.sqrt(bi, out=bi)
+            ai -= ci
+            # s += 2^(n-1) c_n^2
+            ci *= ci
+            weight *= 2
+            ci *= weight
+            si += ci
+
+        Ki = K_flat[i : i + n]
+        np.divide(np.pi / 2, ai, out=Ki)
+        np.subtract(1, si, out=si)
+        np.multiply(Ki, si, out=E_flat[i : i + n])
+
+    return K, E
+
+
+if __name__ == "__main__":
+    import sys
+    from scipy import special
+
+    m = np.concatenate(
+        [np.linspace(0, 1, 1_000_001, endpoint=False), 1 - np.logspace(-15, -1, 1000)]
+    )
+    failed = False
+    for dtype in (np.float64, np.float32):
+        mt = m.astype(dtype)
+        mt = mt[mt < 1]
+        K, E = ellipke(mt)
+        K_ref = special.ellipk(mt.astype(np.float64))
+        E_ref = special.ellipe(mt.astype(np.float64))
+        error_K = np.max(np.abs(K / K_ref - 1))
+        error_E = np.max(np.abs(E / E_ref - 1))
+        tolerance = TOLERANCE * np.finfo(dtype).eps
+        ok = error_K <= tolerance and error_E <= tolerance
+        failed |= not ok
+        print(
+            f"{np.dtype(dtype).name}: {agm_iterations(mt.max(), dtype)} iterations,"
+            f" max relative error K {error_K:.2e}, E {error_E:.2e},"
+            f" tolerance {tolerance:.2e} {'ok' if ok else 'FAILED'}"
+        )
+    sys.exit(1 if failed else 0)
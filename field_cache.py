@@ -0,0 +1,222 @@
+"""Persistent on-disk cache of computed magnetic fields
+
+Fields are stored as `.npy` files named after a hash of everything that
+determines their values and are opened with memory mapping, so re-opening a
+previously computed configuration is near-instant and only the pages that
+are actually read are loaded into RAM. The cache is capped in size and the
+least recently used fields are evicted first.
+
+Fields are stored in their `canonical_form`, so a configuration that only
+differs from a cached one by its size or current is served by rescaling the
+cached field.
+"""
+import hashlib
+import json
+import os
+from typing import Optional, Sequence
+import numpy as np
+
+from field_compute import Coil, Grid, canonical_form, compute_field
+from instrumentation import stage
+
+# Bump when a change to the kernels alters the computed values
+CACHE_VERSION = 3
+
+
+def default_cache_dir() -> str:
+    return os.environ.get(
+        "MAGNETIC_FIELD_CACHE",
+        os.path.join(os.path.expanduser("~"), ".cache", "magnetic_field"),
+    )
+
+
+class FieldCache(object):
+    def __init__(
+        self, directory: Optional[str] = None, max_bytes: float = 2 * 2 ** 30
+    ) -> None:
+        """LRU cache of fields stored as memory-mapped `.npy` files
+
+        Args:
+            directory (str, optional): cache directory. Defaults to
+                $MAGNETIC_FIELD_CACHE or ~/.cache/magnetic_field.
+            max_bytes (float, optional): size cap of the cache.
+                Defaults to 2 GiB.
+        """
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(
+        coils: Sequence[Coil],
+        grid: Grid,
+        dtype=np.float64,
+        engine: str = "direct",
+        tol: float = 1e-3,
+        elliptic: str = "scipy",
+        wire_cutoff: float = 0.0,
+    ) -> str:
+        """Hash of the configuration that determines a computed field"""
+        spacing = complex(grid.sp)
+        config = {
+            "version": CACHE_VERSION,
+            "coils": [[c.radius, c.current, c.centre, c.axis] for c in coils],
+            "grid": [grid.Lx, grid.Ly, grid.Lz, spacing.real, spacing.imag],
+            "dtype": np.dtype(dtype).name,
+            "engine": engine,
+            "elliptic": elliptic,
+        }
+        if engine in ("table", "multipole"):
+            config["tol"] = tol
+        if wire_cutoff:
+            # A fraction of the radius, so it survives `canonical_form`
+            config["wire_cutoff"] = wire_cutoff
+        return hashlib.sha1(json.dumps(config).encode()).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Memory map of a cached field, None if it is not in the cache"""
+        path = self.path(key)
+        try:
+            B = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        # The modification time doubles as the LRU timestamp
+        os.utime(path)
+        return B
+
+    def compute(
+        self,
+        coils: Sequence[Coil],
+        grid: Grid,
+        dtype=np.float64,
+        engine: str = "direct",
+        tol: float = 1e-3,
+        elliptic: str = "scipy",
+        out: Optional[np.ndarray] = None,
+        wire_cutoff: float = 0.0,
+        **kwargs,
+    ) -> np.ndarray:
+        """Return the cached field, computing and storing it on a miss
+
+        On a miss the canonical field is computed straight into the
+        memory-mapped cache file, so it is never held in RAM twice. Extra
+        keyword arguments are passed to `compute_field` and must not change
+        the result, e.g. `memory_limit` or `workers`.
+
+        Args:
+            out (np.ndarray, optional): array to read the (rescaled) field
+                into, e.g. from `point_order_field`. Defaults to None.
+            wire_cutoff (float, optional): wire thickness as a fraction of
+                the radius, see `compute_field`. Defaults to 0.
+
+        Returns:
+            np.ndarray: B with shape (3, nx, ny, nz), a read-only memory map
+            when no `out` is given and no rescaling of the canonical field is
+            needed
+        """
+        coils, grid, factor = canonical_form(coils, grid)
+        key = FieldCache.key(coils, grid, dtype, engine, tol, elliptic, wire_cutoff)
+        with stage("cache_lookup"):
+            B = self.get(key)
+        if B is None:
+            B = self._store(
+                key,
+                coils,
+                grid,
+                dtype,
+                engine,
+                tol,
+                elliptic,
+                wire_cutoff=wire_cutoff,
+                **kwargs,
+            )
+        with stage("rescale"):
+            if out is not None:
+                return np.multiply(B, factor, out=out)
+            if factor == 1.0:
+                return B
+            return np.multiply(B, factor, dtype=B.dtype)
+
+    def _store(
+        self,
+        key: str,
+        coils: Sequence[Coil],
+        grid: Grid,
+        dtype,
+        engine: str,
+        tol: float,
+        elliptic: str,
+        **kwargs,
+    ) -> np.ndarray:
+        """Compute a field into the cache file of `key` and map it"""
+        path = self.path(key)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        out = np.lib.format.open_memmap(
+            tmp, mode="w+", dtype=dtype, shape=(3,) + grid.shape
+        )
+        try:
+            compute_field(
+                coils,
+                grid,
+                engine=engine,
+                tol=tol,
+                dtype=dtype,
+                out=out,
+                elliptic=elliptic,
+                **kwargs,
+            )
+            out.flush()
+        except BaseException:
+            del out
+            os.remove(tmp)
+            raise
+        del out
+        os.replace(tmp, path)
+
+        self.evict(keep=key)
+        return np.load(path, mmap_mode="r")
+
+    def entries(self) -> list:
+        """Cached (path, size, last access) sorted from least recently used"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npy"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+        return sorted(entries, key=lambda e: e[2])
+
+    def size(self) -> int:
+        return sum(e[1] for e in self.entries())
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Remove least recently used fields until the cache fits its cap
+
+        Args:
+            keep (str, optional): key that must not be evicted, e.g. the one
+                that was just stored. Defaults to None.
+        """
+        entries = self.entries()
+        total = sum(e[1] for e in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if keep is not None and path == self.path(keep):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                # Already removed, or still mapped by another process
+                continue
+            total -= size
+
+    def clear(self) -> None:
+        for path, _, _ in self.entries():
+            os.remove(path)
@@ -0,0 +1,1891 @@
+"""Headless magnetic field computation
+
+Pure NumPy/SciPy layer for computing the field of a set of coil loops on a
+grid. Nothing in here imports Mayavi/VTK so it can be used on machines
+without a display and from batch jobs, see `main` for the command line
+entry point::
+
+    python field_compute.py --radius 1.0 --current 1.0 --spacing 100 -o B.npz
+"""
+import argparse
+import json
+import os
+import threading
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Sequence, Tuple
+import numpy as np
+from scipy import special
+
+from elliptic import ellipke
+from instrumentation import Profiler, bind, stage
+from multipole import MULTIPOLE_DEGREE, AxialMultipole
+
+
+class Grid(object):
+    def __init__(
+        self, Lx: float = 0.4, Ly: float = 0.4, Lz: float = 0.4, spacing=50j
+    ) -> None:
+        """Uniform grid over the box [-Lx, Lx] x [-Ly, Ly] x [-Lz, Lz]
+
+        Args:
+            Lx (float, optional): half-width in x. Defaults to 0.4.
+            Ly (float, optional): half-width in y. Defaults to 0.4.
+            Lz (float, optional): half-width in z. Defaults to 0.4.
+            spacing (optional): grid spacing as passed to `np.mgrid`, a complex
+                number is the number of points with inclusive bounds.
+                Defaults to 50j.
+        """
+        self.Lx = Lx
+        self.Ly = Ly
+        self.Lz = Lz
+        self.sp = spacing
+
+    @classmethod
+    def for_radius(cls, radius: float, spacing=50j) -> "Grid":
+        """The default grid of the visualiser, 4 coil radii in each direction"""
+        return cls(radius * 4, radius * 4, radius * 4, spacing)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        return tuple(len(np.ravel(axis)) for axis in self.get_grid("sparse"))
+
+    @property
+    def origin(self) -> Tuple[float, float, float]:
+        return (-self.Lx, -self.Ly, -self.Lz)
+
+    @property
+    def step(self) -> Tuple[float, float, float]:
+        """Distance between neighbouring points along each axis"""
+        axes = [np.ravel(axis) for axis in self.get_grid("sparse")]
+        return tuple(float(a[1] - a[0]) if len(a) > 1 else 1.0 for a in axes)
+
+    def get_grid(
+        self, mat_type: str = "sparse"
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return either a dense or a sparse 3D grid
+
+        Args:
+            mat_type (str, optional): dense or sparse. Defaults to "sparse".
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: x, y, z
+        """
+
+        if mat_type == "sparse":
+            x, y, z = np.ogrid[
+                -self.Lx : self.Lx : self.sp,
+                -self.Ly : self.Ly : self.sp,
+                -self.Lz : self.Lz : self.sp,
+            ]
+            return x, y, z
+        elif mat_type == "dense":
+            x, y, z = np.mgrid[
+                -self.Lx : self.Lx : self.sp,
+                -self.Ly : self.Ly : self.sp,
+                -self.Lz : self.Lz : self.sp,
+            ]
+            return x, y, z
+        else:
+            raise ValueError(f"Input grid format: {mat_type} not supported")
+
+
+def point_order_field(shape: Tuple[int, int, int], dtype=np.float64) -> np.ndarray:
+    """Uninitialised field array laid out in VTK point order
+
+    Returns a (3, nx, ny, nz) view of an (nz, ny, nx, 3) buffer, i.e. with
+    the components interleaved and x varying fastest as in `vtkImageData`.
+    It can be used as the `out` of `compute_field` and friends, after which
+    `B.T.reshape(-1, 3)` is a contiguous (N, 3) view that VTK can use
+    without copying.
+
+    Args:
+        shape (Tuple[int, int, int]): shape of the grid
+        dtype (optional): dtype of the field. Defaults to np.float64.
+
+    Returns:
+        np.ndarray: B with shape (3, nx, ny, nz)
+    """
+    return np.empty(tuple(shape[::-1]) + (3,), dtype=dtype).T
+
+
+class Coil(object):
+    def __init__(
+        self,
+        radius: float,
+        current: float,
+        centre: Sequence[float] = (0.0, 0.0, 0.0),
+        axis: Sequence[float] = (0.0, 0.0, 1.0),
+    ) -> None:
+        """Circular current loop
+
+        Args:
+            radius (float): radius of the coil
+            current (float): current through the coil, positive currents
+                circulate counter-clockwise when looking down `axis`
+            centre (Sequence[float], optional): centre of the coil.
+                Defaults to (0.0, 0.0, 0.0).
+            axis (Sequence[float], optional): normal of the coil plane, does
+                not need to be normalised. Defaults to (0.0, 0.0, 1.0).
+        """
+        self.radius = radius
+        self.current = current
+        self.centre = tuple(float(c) for c in centre)
+        norm = np.sqrt(sum(float(a) ** 2 for a in axis))
+        if norm == 0:
+            raise ValueError("Coil axis must be a non-zero vector")
+        self.axis = tuple(float(a) / norm for a in axis)
+
+    def __repr__(self) -> str:
+        return (
+            f"Coil(radius={self.radius}, current={self.current},"
+            f" centre={self.centre}, axis={self.axis})"
+        )
+
+
+def coil_pair(
+    radius: float, current: float, separation: Optional[float] = None
+) -> List[Coil]:
+    """The two parallel coils of the visualiser, by default a radius apart"""
+    h = (radius if separation is None else separation) / 2.0
+    return [
+        Coil(radius, current, centre=(0, 0, +h)),
+        Coil(radius, current, centre=(0, 0, -h)),
+    ]
+
+
+def helmholtz(radius: float, current: float, pairs: int = 1) -> List[Coil]:
+    """Stack of Helmholtz pairs, each pair a radius apart and centred on z=0
+
+    Successive pairs are placed side by side along z, a radius apart, which
+    extends the uniform region along the axis.
+    """
+    coils = []
+    for p in range(pairs):
+        offset = (p - (pairs - 1) / 2.0) * 2 * radius
+        coils += [
+            Coil(radius, current, centre=(0, 0, offset + radius / 2.0)),
+            Coil(radius, current, centre=(0, 0, offset - radius / 2.0)),
+        ]
+    return coils
+
+
+def anti_helmholtz(radius: float, current: float) -> List[Coil]:
+    """Helmholtz pair with opposing currents (quadrupole field)"""
+    return [
+        Coil(radius, +current, centre=(0, 0, +radius / 2.0)),
+        Coil(radius, -current, centre=(0, 0, -radius / 2.0)),
+    ]
+
+
+def maxwell(radius: float, current: float) -> List[Coil]:
+    """Maxwell coil, a central loop and two smaller loops on a common sphere"""
+    outer = radius * np.sqrt(4.0 / 7.0)
+    h = radius * np.sqrt(3.0 / 7.0)
+    return [
+        Coil(outer, current * 49.0 / 64.0, centre=(0, 0, +h)),
+        Coil(radius, current, centre=(0, 0, 0)),
+        Coil(outer, current * 49.0 / 64.0, centre=(0, 0, -h)),
+    ]
+
+
+# Coil configurations selectable by name from the GUI and command line
+CONFIGURATIONS = {
+    "pair": coil_pair,
+    "helmholtz": helmholtz,
+    "anti-helmholtz": anti_helmholtz,
+    "maxwell": maxwell,
+}
+
+
+class CoilSet(object):
+    def __init__(
+        self, coils: Sequence[Coil], elliptic: str = "scipy", wire_cutoff: float = 0.0
+    ) -> None:
+        """Arbitrary set of coil loops evaluated with a fused kernel
+
+        Coils sharing the same axis line (coaxial coils) share rho and the
+        radial unit vectors, which are only computed once per group. Every
+        coil is then accumulated into a single output buffer using a fixed
+        number of work arrays, so memory does not grow with the number of
+        coils and no per-coil copies of the field are made.
+
+        Args:
+            coils (Sequence[Coil]): coils contributing to the field
+            elliptic (str, optional): backend for the elliptic integrals,
+                "scipy" or "agm" for `elliptic.ellipke`. Defaults to "scipy".
+            wire_cutoff (float, optional): the field is zero closer to a wire
+                than this fraction of the coil radius, see `loop_field`.
+                Defaults to 0.0, only points on the wire.
+        """
+        if elliptic not in ("scipy", "agm"):
+            raise ValueError(f"Elliptic integral backend: {elliptic} not supported")
+        self.coils = list(coils)
+        self.elliptic = elliptic
+        self.wire_cutoff = wire_cutoff
+
+    def __len__(self) -> int:
+        return len(self.coils)
+
+    def __iter__(self):
+        return iter(self.coils)
+
+    def coaxial_groups(
+        self,
+    ) -> List[Tuple[tuple, tuple, List[Tuple[float, float, Coil]]]]:
+        """Group the coils by the line of their axis
+
+        Antiparallel axes are folded onto the same line by flipping the sign
+        of the current, since a loop with axis -a and current I is the same
+        as a loop with axis a and current -I.
+
+        Returns:
+            List[Tuple[tuple, tuple, List[Tuple[float, float, Coil]]]]: for
+            every group the unit axis, a point on the axis line, and for
+            every coil its axial offset from that point, the sign (+1 or -1)
+            its current is multiplied by when its axis was flipped, and the
+            coil itself
+        """
+        groups = {}
+        for coil in self.coils:
+            a = np.array(coil.axis)
+            sign = 1.0
+            if a[np.flatnonzero(np.abs(a) > 1e-12)[0]] < 0:
+                a, sign = -a, -1.0
+            c = np.array(coil.centre)
+            offset = float(c @ a)
+            base = c - offset * a
+            key = tuple(np.round(np.concatenate([a, base]), 12))
+            if key not in groups:
+                # Python floats, numpy float64 scalars would upcast float32
+                # arrays in the kernels
+                groups[key] = (tuple(map(float, a)), tuple(map(float, base)), [])
+            groups[key][2].append((offset, sign, coil))
+        return list(groups.values())
+
+    def on_wire(self, x: np.ndarray, y: np.ndarray, z: np.ndarray) -> np.ndarray:
+        """Points where the field of a coil is zeroed, see `wire_cutoff`
+
+        Returns:
+            np.ndarray: boolean mask with the broadcast shape of x, y and z
+        """
+        wire = np.zeros(np.broadcast(x, y, z).shape, dtype=bool)
+        for coil in self.coils:
+            d = [np.asarray(a, dtype=float) - c for a, c in zip((x, y, z), coil.centre)]
+            t = sum(a * dk for a, dk in zip(coil.axis, d) if a != 0)
+            rho2 = np.maximum(d[0] ** 2 + d[1] ** 2 + d[2] ** 2 - t * t, 0.0)
+            R = coil.radius
+            # Squared distance from the wire, as in `loop_field`
+            distance2 = (np.sqrt(rho2) - R) ** 2 + t * t
+            wire |= distance2 <= _wire_cutoff2(R * R, self.wire_cutoff, np.float64)
+        return wire
+
+    def field(
+        self,
+        x: np.ndarray,
+        y: np.ndarray,
+        z: np.ndarray,
+        out: Optional[np.ndarray] = None,
+        dtype=np.float64,
+    ) -> np.ndarray:
+        """Accumulate the field of all coils on a grid
+
+        Args:
+            x (np.ndarray): generated by `np.ogrid` or `np.mgrid`
+            y (np.ndarray): generated by `np.ogrid` or `np.mgrid`
+            z (np.ndarray): generated by `np.ogrid` or `np.mgrid`
+            out (np.ndarray, optional): buffer of shape (3, *grid) to add the
+                field to. Defaults to a new zeroed array.
+            dtype (optional): dtype of a new output buffer and of the work
+                arrays. Defaults to np.float64.
+
+        Returns:
+            np.ndarray: B with shape (3, *grid)
+        """
+        shape = np.broadcast(x, y, z).shape
+        if out is None:
+            out = np.zeros((3,) + shape, dtype=dtype)
+        # Compute in the precision of the output
+        x, y, z = (np.asarray(a, dtype=out.dtype) for a in (x, y, z))
+        work = np.empty((5,) + shape, dtype=out.dtype)
+
+        for axis, base, members in self.coaxial_groups():
+            with stage("coordinates") as st:
+                d = (x - base[0], y - base[1], z - base[2])
+                # Skip the zero components of the axis so that axis aligned
+                # coils on a sparse grid keep all geometric terms sparse
+                t = sum(a * dk for a, dk in zip(axis, d) if a != 0)
+                radial = [
+                    None if a == 1.0 else (dk - a * t if a != 0 else dk)
+                    for a, dk in zip(axis, d)
+                ]
+                rho2 = sum(r ** 2 for r in radial if r is not None)
+                rho = np.sqrt(rho2)
+                # r/rho^2 turns rho * B_rho into the Cartesian components, on
+                # the axis B_rho vanishes so any finite value does
+                inv_rho2 = np.zeros_like(rho2)
+                np.divide(1.0, rho2, out=inv_rho2, where=rho2 > 0)
+                radial = [None if r is None else r * inv_rho2 for r in radial]
+                # Candidates for the series of `_near_axis_field`, a thin
+                # column around the axis refined for every coil
+                R_max = max(abs(coil.radius) for _, _, coil in members)
+                z_max = np.abs(t).max(initial=0) + max(abs(o) for o, _, _ in members)
+                limit = _near_axis_limit(out.dtype) * (R_max ** 2 + z_max ** 2)
+                near_axis = rho2 < limit
+                if near_axis.any():
+                    # Gathered once, the coils only differ by their offset
+                    near_axis = np.broadcast_to(near_axis, shape)
+                    index = np.flatnonzero(near_axis)
+                    rho2_a = np.broadcast_to(rho2, shape)[near_axis]
+                    t_a = np.broadcast_to(t, shape)[near_axis]
+                else:
+                    near_axis = None
+                st.array("rho", rho)
+                st.array("work", work)
+
+            for offset, sign, coil in members:
+                _accumulate_coil(
+                    out,
+                    work,
+                    rho,
+                    rho2,
+                    t - offset,
+                    radial,
+                    axis,
+                    coil.radius,
+                    sign * coil.current,
+                    self.elliptic,
+                    self.wire_cutoff,
+                    None if near_axis is None else (index, rho2_a, t_a - offset),
+                )
+
+        return out
+
+
+def _near_axis_limit(dtype) -> float:
+    """Largest v = rho^2 / (R^2 + z^2) at which the series about the axis
+    are used
+
+    The closed form of rho B_rho cancels K and E to a relative error of about
+    eps / v, v = rho^2 / u, the series of `_near_axis_field` truncate at a
+    relative v^3 with a coefficient of order 100, which balance near
+    (eps / 256)^(1/4).
+    """
+    return (float(np.finfo(dtype).eps) / 256) ** 0.25
+
+
+def _wire_cutoff2(R2: float, wire_cutoff: float, dtype) -> float:
+    """Squared distance from the wire within which the field is zeroed
+
+    Never below 16 eps R^2, so that outside of it d > 0 and the elliptic
+    parameter stays representably below 1, where K diverges.
+    """
+    return max(wire_cutoff ** 2, 16 * float(np.finfo(dtype).eps)) * R2
+
+
+def _near_axis_field(
+    rho2: np.ndarray, z: np.ndarray, R2: float, I: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """B_z and rho B_rho of a loop from their series in rho about the axis
+
+    With the on-axis field B_0(z) = pi I R^2 u^(-3/2), u = R^2 + z^2 and its
+    derivatives B_0^(k), B_z = B_0 - rho^2 B_0^(2) / 4 + rho^4 B_0^(4) / 64
+    and rho B_rho = -rho^2 B_0^(1) / 2 + rho^4 B_0^(3) / 16
+    - rho^6 B_0^(5) / 384, i.e. with v = rho^2 / u::
+
+        B_z       = B_0 (1 - 3/4 v (4z^2 - R^2) / u
+                         + 45/64 v^2 (R^4 - 12 R^2 z^2 + 8 z^4) / u^2)
+        rho B_rho = B_0 z v (3/2 + 15/16 v (3R^2 - 4z^2) / u
+                             + 105/128 v^2 (5R^4 - 20 R^2 z^2 + 8 z^4) / u^2)
+
+    both to a relative O(v^3), and exact on the axis.
+    """
+    z2 = z * z
+    u = R2 + z2
+    v = rho2 / u
+    B0 = np.pi * I * R2 / (u * np.sqrt(u))
+    Bz = B0 * (
+        1
+        - 0.75 * v * (4 * z2 - R2) / u
+        + 45 / 64 * v * v * (R2 * R2 - 12 * R2 * z2 + 8 * z2 * z2) / (u * u)
+    )
+    rho_Brho = (
+        B0
+        * z
+        * v
+        * (
+            1.5
+            + 15 / 16 * v * (3 * R2 - 4 * z2) / u
+            + 105 / 128 * v * v * (5 * R2 * R2 - 20 * R2 * z2 + 8 * z2 * z2) / (u * u)
+        )
+    )
+    return Bz, rho_Brho
+
+
+def loop_field(
+    rho2: np.ndarray,
+    z: np.ndarray,
+    radius: float,
+    current: float,
+    wire_cutoff: float = 0.0,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Field of a single loop in cylindrical coordinates, finite everywhere
+
+    Points are classified up front instead of scrubbing NaN/Inf afterwards:
+    near the axis the series of `_near_axis_field` replace the closed form,
+    which loses digits there, and within `wire_cutoff` of the wire, where the
+    field diverges, it is zero. No intermediate is ever non-finite.
+
+    Args:
+        rho2 (np.ndarray): squared distance from the coil axis
+        z (np.ndarray): axial distance from the coil plane
+        radius (float): radius of the coil
+        current (float): current through the coil
+        wire_cutoff (float, optional): distance from the wire within which
+            the field is zero, as a fraction of the radius. Defaults to 0.0,
+            only points on the wire.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: B_z and rho * B_rho, which is finite
+        and smooth on the axis unlike B_rho / rho
+    """
+    R = radius
+    I = current
+    if abs(radius) < 1e-10:
+        R = 1e-10
+    if abs(current) < 1e-10:
+        I = 1e-10
+    R2 = R * R
+
+    rho2, z = np.broadcast_arrays(np.asarray(rho2, dtype=float), z)
+    q = rho2 + z * z
+    rho = np.sqrt(rho2)
+    two_R_rho = 2 * R * rho
+    s = q + R2 + two_R_rho
+    # Squared distance from the wire, without the cancellation of q + R^2 - 2 R rho
+    d = (rho - R) ** 2 + z * z
+
+    # Any finite values on the wire, the field is zeroed there below
+    wire = d <= _wire_cutoff2(R2, wire_cutoff, d.dtype)
+    d[wire] = R2
+    m = 2 * two_R_rho / s
+    m[wire] = 0.0
+
+    E_over_d = special.ellipe(m) / d
+    K = special.ellipk(m)
+    sqrt_s = np.sqrt(s)
+    Bz = I / sqrt_s * (K + (R2 - q) * E_over_d)
+    rho_Brho = I * z / sqrt_s * (-K + (R2 + q) * E_over_d)
+
+    near_axis = rho2 < _near_axis_limit(d.dtype) * (R2 + z * z)
+    if near_axis.any():
+        Bz[near_axis], rho_Brho[near_axis] = _near_axis_field(
+            rho2[near_axis], z[near_axis], R2, I
+        )
+    Bz[wire] = 0.0
+    rho_Brho[wire] = 0.0
+    return Bz, rho_Brho
+
+
+def _accumulate_coil(
+    out: np.ndarray,
+    work: np.ndarray,
+    rho: np.ndarray,
+    rho2: np.ndarray,
+    z: np.ndarray,
+    radial: List[Optional[np.ndarray]],
+    axis: Tuple[float, float, float],
+    radius: float,
+    current: float,
+    elliptic: str = "scipy",
+    wire_cutoff: float = 0.0,
+    near_axis: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None,
+) -> None:
+    """Add the field of a single coil to `out` in place
+
+    Evaluates the same expressions as `loop_field`, rewritten in terms of
+    q = rho^2 + z^2 so that every full-size intermediate lives in one of the 5
+    `work` arrays::
+
+        s = R^2 + 2 R rho + q        d = R^2 - 2 R rho + q
+        B_z       = I / sqrt(s) * (K + (R^2 - q) E / d)
+        rho B_rho = I z / sqrt(s) * (-K + (R^2 + q) E / d)
+
+    with the same classification of the points on the wire and near the
+    axis, so no intermediate is ever non-finite.
+
+    Args:
+        out (np.ndarray): (3, *grid) field to add to
+        work (np.ndarray): (5, *grid) scratch arrays
+        rho (np.ndarray): distance from the coil axis
+        rho2 (np.ndarray): rho^2
+        z (np.ndarray): axial distance from the coil plane
+        radial (List[Optional[np.ndarray]]): Cartesian components of
+            r / rho^2, None where the component is zero
+        axis (Tuple[float, float, float]): unit axis of the coil
+        radius (float): radius of the coil
+        current (float): current through the coil
+        elliptic (str, optional): "scipy" or "agm" to obtain K and E from a
+            single AGM iteration. Defaults to "scipy".
+        wire_cutoff (float, optional): distance from the wire within which
+            the field is zero, as a fraction of the radius. Defaults to 0.0.
+        near_axis (Tuple[np.ndarray, np.ndarray, np.ndarray], optional): flat
+            indices into the grid, rho^2 and z of the candidates for the
+            series about the axis, which are used where
+            rho^2 / (R^2 + z^2) < `_near_axis_limit`. Defaults to None, no
+            candidates.
+    """
+    R = radius
+    I = current
+    if abs(radius) < 1e-10:
+        R = 1e-10
+    if abs(current) < 1e-10:
+        I = 1e-10
+    R2 = R * R
+
+    s, d, m, K, q = work
+    with stage("geometry"):
+        z2 = z * z
+        np.add(rho2, z2, out=q)
+        two_R_rho = 2 * R * rho
+        np.add(q, R2 + two_R_rho, out=s)
+        # (rho - R)^2 + z^2 rather than q + R^2 - 2 R rho, which cancels near
+        # the wire and costs float32 most of its digits there
+        np.add((rho - R) ** 2, z2, out=d)
+        np.divide(2 * two_R_rho, s, out=m)
+    with stage("singularities"):
+        wire = np.less_equal(d, _wire_cutoff2(R2, wire_cutoff, d.dtype))
+        on_wire = wire.any()
+        if on_wire:
+            # Any finite values on the wire, the field is zeroed there below
+            np.copyto(d, R2, where=wire)
+            np.copyto(m, 0.0, where=wire)
+    with stage("elliptic") as st:
+        st.array("m", m)
+        if elliptic == "agm":
+            ellipke(m, K=K, E=m)
+        else:
+            special.ellipk(m, out=K)
+            special.ellipe(m, out=m)
+    with stage("expressions"):
+        E_over_d = m
+        np.divide(E_over_d, d, out=E_over_d)
+        sqrt_s = np.sqrt(s, out=s)
+
+        # B_z
+        Bz = np.subtract(R2, q, out=d)
+        Bz *= E_over_d
+        Bz += K
+        Bz /= sqrt_s
+        Bz *= I
+        # rho * B_rho
+        rho_Brho = np.add(q, R2, out=q)
+        rho_Brho *= E_over_d
+        rho_Brho -= K
+        rho_Brho /= sqrt_s
+        rho_Brho *= I * z
+
+    with stage("singularities"):
+        if near_axis is not None:
+            # Indexed by position, a boolean mask would scan the whole grid
+            index, rho2_a, z_a = near_axis
+            series = rho2_a < _near_axis_limit(Bz.dtype) * (R2 + z_a * z_a)
+            Bz_a, rho_Brho_a = _near_axis_field(rho2_a[series], z_a[series], R2, I)
+            Bz.put(index[series], Bz_a)
+            rho_Brho.put(index[series], rho_Brho_a)
+        # Physically the field is undefined on the wire, zero it
+        if on_wire:
+            np.copyto(Bz, 0.0, where=wire)
+            np.copyto(rho_Brho, 0.0, where=wire)
+
+    with stage("accumulate"):
+        tmp = m
+        for k in range(3):
+            if radial[k] is not None:
+                np.multiply(rho_Brho, radial[k], out=tmp)
+                out[k] += tmp
+            if axis[k] != 0:
+                if axis[k] == 1.0:
+                    out[k] += Bz
+                else:
+                    np.multiply(Bz, axis[k], out=tmp)
+                    out[k] += tmp
+
+
+# Approximate number of full-size scratch arrays per engine, used to turn a
+# memory budget into a slab size
+_WORK_ARRAYS = {"direct": 6, "table": 2, "multipole": 13}
+# Points per chunk of `hybrid_field`, bounds its scratch memory
+_HYBRID_CHUNK = 2 ** 18
+
+
+def slab_size(
+    shape: Tuple[int, int, int],
+    memory_limit: Optional[float] = None,
+    engine: str = "direct",
+    dtype=np.float64,
+) -> int:
+    """Number of z planes per slab that fit in a memory budget
+
+    Args:
+        shape (Tuple[int, int, int]): shape of the grid
+        memory_limit (float, optional): budget in bytes for the scratch
+            arrays of a slab, not counting the output. Defaults to no limit.
+        engine (str, optional): field engine. Defaults to "direct".
+        dtype (optional): dtype of the computation. Defaults to np.float64.
+
+    Returns:
+        int: slab thickness, at least 1
+    """
+    if memory_limit is None:
+        return shape[2]
+    plane = shape[0] * shape[1] * np.dtype(dtype).itemsize * _WORK_ARRAYS[engine]
+    return int(min(shape[2], max(1, memory_limit // plane)))
+
+
+def _slabs(n: int, step: int) -> List[slice]:
+    return [slice(k, min(k + step, n)) for k in range(0, n, step)]
+
+
+def _field_slab(
+    coils: Sequence[Coil],
+    x: np.ndarray,
+    y: np.ndarray,
+    z: np.ndarray,
+    out: np.ndarray,
+    engine: str,
+    tol: float,
+    elliptic: str = "scipy",
+    wire_cutoff: float = 0.0,
+) -> np.ndarray:
+    """Add the field of `coils` on the sparse grid (x, y, z) to `out`"""
+    if engine == "direct":
+        return CoilSet(coils, elliptic, wire_cutoff).field(x, y, z, out=out)
+    elif engine == "table":
+        if any(coil.axis != (0.0, 0.0, 1.0) for coil in coils):
+            raise ValueError("The table engine only supports coils along z")
+        if wire_cutoff:
+            raise ValueError("The table engine does not support a wire cutoff")
+        for coil in coils:
+            magnetic_field_single_coil_table(
+                x,
+                y,
+                z,
+                coil.radius,
+                coil.current,
+                centre=coil.centre,
+                tol=tol,
+                out=out,
+            )
+        return out
+    elif engine == "multipole":
+        return hybrid_field(
+            coils, x, y, z, out=out, tol=tol, elliptic=elliptic, wire_cutoff=wire_cutoff
+        )[0]
+    else:
+        raise ValueError(f"Field engine: {engine} not supported")
+
+
+def coaxial_multipoles(
+    coils: Sequence[Coil], tol: float = 1e-3, degree: int = MULTIPOLE_DEGREE
+) -> List[Tuple[np.ndarray, np.ndarray, List[Coil], AxialMultipole, float]]:
+    """Far-field expansions of the coaxial groups of a coil set
+
+    The error budget of every group is `tol` times the largest field at the
+    centre of any coil, pi |I| / R, so the far-field radius of each group is
+    where its truncation error drops below that fraction of the peak field.
+
+    Returns:
+        List[Tuple[np.ndarray, np.ndarray, List[Coil], AxialMultipole, float]]:
+        for every group the unit axis, the expansion centre, the coils, the
+        expansion and its far-field radius
+    """
+    scale = max((np.pi * abs(c.current) / abs(c.radius) for c in coils), default=0.0)
+    groups = []
+    for axis, base, members in CoilSet(coils).coaxial_groups():
+        loops = [(offset, c.radius, sign * c.current) for offset, sign, c in members]
+        multipole = AxialMultipole(loops, degree)
+        axis = np.array(axis)
+        centre = np.array(base) + multipole.centre * axis
+        r_far = multipole.radius_for(tol * scale)
+        groups.append((axis, centre, [m[2] for m in members], multipole, r_far))
+    return groups
+
+
+def hybrid_field(
+    coils: Sequence[Coil],
+    x: np.ndarray,
+    y: np.ndarray,
+    z: np.ndarray,
+    out: Optional[np.ndarray] = None,
+    tol: float = 1e-3,
+    elliptic: str = "scipy",
+    degree: int = MULTIPOLE_DEGREE,
+    wire_cutoff: float = 0.0,
+) -> Tuple[np.ndarray, float]:
+    """Exact field near the coils, multipole expansion far from them
+
+    Every coaxial group of coils is evaluated with its `AxialMultipole`
+    beyond the radius where the truncation error is below `tol` of the peak
+    field, see `coaxial_multipoles`, and with the exact `CoilSet` kernel
+    inside it. A group's expansion costs about as much as one exact coil, so
+    stacks of coaxial coils gain the most. The points are processed in chunks
+    of about `_HYBRID_CHUNK` along the last axis, which bounds the scratch
+    memory.
+
+    Args:
+        coils (Sequence[Coil]): coils contributing to the field
+        x (np.ndarray): generated by `np.ogrid` or `np.mgrid`
+        y (np.ndarray): generated by `np.ogrid` or `np.mgrid`
+        z (np.ndarray): generated by `np.ogrid` or `np.mgrid`
+        out (np.ndarray, optional): buffer of shape (3, *grid) to add the
+            field to. Defaults to a new zeroed array.
+        tol (float, optional): truncation error tolerance relative to the
+            peak field. Defaults to 1e-3.
+        elliptic (str, optional): elliptic integral backend of the exact
+            kernel. Defaults to "scipy".
+        degree (int, optional): highest multipole degree. Defaults to
+            `MULTIPOLE_DEGREE`.
+        wire_cutoff (float, optional): wire thickness of the exact kernel as
+            a fraction of the radius, see `CoilSet`. Defaults to 0.
+
+    Returns:
+        Tuple[np.ndarray, float]: B with shape (3, *grid) and the bound of
+        the truncation error over all points, in field units
+    """
+    shape = np.broadcast(x, y, z).shape
+    if out is None:
+        out = np.zeros((3,) + shape)
+    x, y, z = (np.asarray(a, dtype=out.dtype) for a in (x, y, z))
+    groups = coaxial_multipoles(coils, tol, degree)
+    if not shape:
+        return out, _hybrid_chunk(groups, x, y, z, out, elliptic, wire_cutoff)
+
+    # Classified and evaluated in chunks along the last axis, so the masks
+    # and temporaries stay small however large the grid or slab is
+    plane = int(np.prod(shape[:-1]))
+    step = max(1, _HYBRID_CHUNK // max(plane, 1))
+    error = 0.0
+    for k in _slabs(shape[-1], step):
+        chunk = [a[..., k] if a.ndim and a.shape[-1] > 1 else a for a in (x, y, z)]
+        bound = _hybrid_chunk(groups, *chunk, out[..., k], elliptic, wire_cutoff)
+        error = max(error, bound)
+    return out, error
+
+
+def _hybrid_chunk(
+    groups: List[Tuple[np.ndarray, np.ndarray, List[Coil], AxialMultipole, float]],
+    x: np.ndarray,
+    y: np.ndarray,
+    z: np.ndarray,
+    out: np.ndarray,
+    elliptic: str,
+    wire_cutoff: float,
+) -> float:
+    """Add the field of `coaxial_multipoles` groups to `out`, see `hybrid_field`"""
+    shape = out.shape[1:]
+    error = 0.0
+    for axis, centre, members, multipole, r_far in groups:
+        # Python floats keep float32 coordinates in float32
+        axis, centre = tuple(map(float, axis)), tuple(map(float, centre))
+        with stage("classify"):
+            r2 = np.square(x - centre[0]) + np.square(y - centre[1])
+            r2 = np.add(r2, np.square(z - centre[2]), out=np.empty(shape, out.dtype))
+            far = r2 >= r_far ** 2
+        if not far.any():
+            CoilSet(members, elliptic, wire_cutoff).field(x, y, z, out=out)
+            continue
+
+        with stage("multipole") as st:
+            d = [
+                np.broadcast_to(a - c, shape)[far] for a, c in zip((x, y, z), centre)
+            ]
+            r2_far = r2[far]
+            del r2
+            st.array("r2", r2_far)
+            t = sum(a * dk for a, dk in zip(axis, d) if a != 0)
+            B_axis, B_rho = multipole.field(t, r2_far)
+            for k in range(3):
+                # B_rho / rho times the radial vector d - t axis
+                Bk = B_rho * (d[k] - axis[k] * t) if axis[k] != 0 else B_rho * d[k]
+                if axis[k] != 0:
+                    Bk += axis[k] * B_axis
+                out[k][far] += Bk
+            error += multipole.error_bound(np.sqrt(r2_far.min()))
+            del d, t, B_axis, B_rho, Bk
+
+        near = ~far
+        if near.any():
+            with stage("exact"):
+                points = [np.broadcast_to(a, shape)[near] for a in (x, y, z)]
+                exact = CoilSet(members, elliptic, wire_cutoff)
+                B = exact.field(*points, dtype=out.dtype)
+                for k in range(3):
+                    out[k][near] += B[k]
+
+    return error
+
+
+def iter_field_slabs(
+    coils: Sequence[Coil],
+    grid: Grid,
+    engine: str = "direct",
+    tol: float = 1e-3,
+    dtype=np.float64,
+    memory_limit: Optional[float] = None,
+    elliptic: str = "scipy",
+    workers: Optional[int] = 1,
+    point_order: bool = False,
+    wire_cutoff: float = 0.0,
+) -> Iterator[Tuple[slice, np.ndarray]]:
+    """Compute the field one z-slab at a time
+
+    Only a single slab of the field is resident at any time, which allows
+    streaming fields larger than memory to disk. With several `workers` the
+    next slabs are computed while the current one is consumed, with at most
+    one slab per worker in flight, and the slabs are still yielded in order.
+
+    Args:
+        workers (int, optional): number of threads, None uses all cores.
+            Defaults to 1.
+        point_order (bool, optional): lay the slabs out in VTK point order,
+            see `point_order_field`, so that consecutive slabs are
+            consecutive runs of points. Defaults to False.
+        wire_cutoff (float, optional): wire thickness as a fraction of the
+            radius, see `compute_field`. Defaults to 0.
+
+    Yields:
+        Tuple[slice, np.ndarray]: z index range of the slab and the field on
+        it with shape (3, nx, ny, nz_slab)
+    """
+    x, y, z = grid.get_grid("sparse")
+    nz = z.shape[2]
+    step = slab_size(grid.shape, memory_limit, engine, dtype)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1:
+        step = min(step, -(-nz // (4 * workers)))
+
+    def run(k: slice) -> Tuple[slice, np.ndarray]:
+        shape = (x.shape[0], y.shape[1], k.stop - k.start)
+        if point_order:
+            out = point_order_field(shape, dtype)
+            out[...] = 0
+        else:
+            out = np.zeros((3,) + shape, dtype=dtype)
+        return k, _field_slab(
+            coils, x, y, z[:, :, k], out, engine, tol, elliptic, wire_cutoff
+        )
+
+    if workers == 1:
+        for k in _slabs(nz, step):
+            yield run(k)
+        return
+    bound = bind(run)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for k in _slabs(nz, step):
+            pending.append(pool.submit(bound, k))
+            if len(pending) >= workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _coil_signature(coil: Coil, digits: int = 12) -> Tuple[float, ...]:
+    """Hashable description of a loop, folding the axis sign into the current"""
+    a = np.array(coil.axis)
+    current = coil.current
+    if a[np.flatnonzero(np.abs(a) > 1e-12)[0]] < 0:
+        a, current = -a, -current
+    values = (coil.radius, current) + tuple(coil.centre) + tuple(a)
+    return tuple(round(v, digits) + 0.0 for v in values)
+
+
+def reflection_symmetries(
+    coils: Sequence[Coil], grid: Grid
+) -> List[Optional[Tuple[int, int, int]]]:
+    """Mirror symmetries of the field about the planes x=0, y=0 and z=0
+
+    Reflecting a loop through a plane with normal e_k maps it to a loop with
+    centre M c and axis -M a, where M flips the k-th coordinate, as the
+    magnetic moment is a pseudovector. If the reflected coil set equals the
+    original one up to an overall sign s of the currents, the field obeys
+
+        B(M r) = -s M B(r)
+
+    e.g. for `coil_pair` Bx is odd in x, By and Bz are even, and Bx, By are
+    odd in z. A plane is only reported if the grid is symmetric about it too.
+
+    Returns:
+        List[Optional[Tuple[int, int, int]]]: for each axis the signs of the
+        (Bx, By, Bz) components under the reflection, None if not symmetric
+    """
+    axes = [np.ravel(a) for a in grid.get_grid("sparse")]
+    original = sorted(_coil_signature(c) for c in coils)
+    negated = sorted(
+        _coil_signature(Coil(c.radius, -c.current, c.centre, c.axis)) for c in coils
+    )
+
+    symmetries = []
+    for k in range(3):
+        scale = max(np.abs(axes[k]).max(initial=0), 1e-300)
+        if not np.allclose(axes[k], -axes[k][::-1], rtol=0, atol=1e-12 * scale):
+            symmetries.append(None)
+            continue
+        M = np.ones(3)
+        M[k] = -1
+        reflected = sorted(
+            _coil_signature(Coil(c.radius, c.current, M * c.centre, -M * c.axis))
+            for c in coils
+        )
+        if reflected == original:
+            s = 1
+        elif reflected == negated:
+            s = -1
+        else:
+            symmetries.append(None)
+            continue
+        symmetries.append(tuple(int(-s * m) for m in M))
+    return symmetries
+
+
+class ComputationCancelled(Exception):
+    """Raised by `compute_field` when its `cancel` event is set"""
+
+
+def compute_field(
+    coils: Sequence[Coil],
+    grid: Grid,
+    engine: str = "direct",
+    tol: float = 1e-3,
+    dtype=np.float64,
+    memory_limit: Optional[float] = None,
+    out: Optional[np.ndarray] = None,
+    workers: Optional[int] = 1,
+    elliptic: str = "scipy",
+    symmetry: bool = False,
+    progress: Optional[Callable[[int, int], None]] = None,
+    cancel: Optional[threading.Event] = None,
+    wire_cutoff: float = 0.0,
+) -> np.ndarray:
+    """Magnetic field of a set of coils on a grid
+
+    With a `memory_limit` the grid is processed in z-slabs sized so that the
+    scratch arrays of each slab stay within the budget, the results are
+    written straight into the output array. With several `workers` the slabs
+    are evaluated by a thread pool, every point is still computed with the
+    exact same operations so the result is bit-identical to the serial one.
+
+    With `symmetry` the mirror planes found by `reflection_symmetries` are
+    used to only evaluate the fundamental region of the grid, down to one
+    octant for axisymmetric coil sets that are also symmetric about z=0, and
+    the rest is filled in by sign-aware mirrored copies.
+
+    Args:
+        coils (Sequence[Coil]): coils contributing to the field
+        grid (Grid): grid to evaluate the field on
+        engine (str, optional): "direct" evaluates the elliptic integrals at
+            every grid point with the fused `CoilSet` kernel, "table" uses
+            `magnetic_field_single_coil_table` and "multipole" uses
+            `hybrid_field`. Defaults to "direct".
+        tol (float, optional): relative error tolerance of the "table" and
+            "multipole" engines. Defaults to 1e-3.
+        dtype (optional): precision of the computation and of the output,
+            np.float32 halves the memory and the time of the arithmetic,
+            scipy still evaluates the elliptic integrals in double precision
+            internally. Defaults to np.float64.
+        memory_limit (float, optional): budget in bytes for the scratch
+            arrays, not counting the output. Defaults to no limit.
+        out (np.ndarray, optional): array of shape (3, nx, ny, nz) to write
+            the field to, e.g. a memory map. Defaults to a new array.
+        workers (int, optional): number of threads, None uses all cores. The
+            memory budget applies to each worker. Defaults to 1.
+        elliptic (str, optional): elliptic integral backend of the "direct"
+            engine, "scipy" or "agm". Defaults to "scipy".
+        symmetry (bool, optional): exploit mirror symmetries. Defaults to False.
+        progress (Callable[[int, int], None], optional): called with the
+            number of finished and total slabs after every slab, from the
+            worker threads. Defaults to None.
+        cancel (threading.Event, optional): checked before every slab, when
+            set the computation stops by raising `ComputationCancelled`.
+            Defaults to None.
+        wire_cutoff (float, optional): the field is zero closer to a wire
+            than this fraction of its radius, see `CoilSet`. Not supported
+            by the "table" engine. Defaults to 0.
+
+    Returns:
+        np.ndarray: B with shape (3, nx, ny, nz)
+    """
+    with stage("grid") as st:
+        x, y, z = grid.get_grid("sparse")
+        if out is None:
+            out = np.zeros((3,) + grid.shape, dtype=dtype)
+        else:
+            out[...] = 0
+        st.array("B", out)
+
+    # Start of the evaluated region along each axis, for mirror symmetric
+    # axes the half with non-negative coordinates
+    symmetries = [None, None, None]
+    if symmetry:
+        symmetries = reflection_symmetries(coils, grid)
+    lo = [n // 2 if s is not None else 0 for n, s in zip(grid.shape, symmetries)]
+    x, y = x[lo[0] :], y[:, lo[1] :]
+
+    nz = z.shape[2]
+    region = (x.shape[0], y.shape[1], nz - lo[2])
+    step = slab_size(region, memory_limit, engine, out.dtype)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1:
+        # A few slabs per worker to balance the load
+        step = min(step, -(-region[2] // (4 * workers)))
+    if progress is not None or cancel is not None:
+        # Enough slabs for a smooth progress bar and a quick cancel
+        step = min(step, -(-region[2] // 32))
+
+    lock = threading.Lock()
+    finished = [0]
+
+    def run(k: slice) -> None:
+        if cancel is not None and cancel.is_set():
+            raise ComputationCancelled()
+        _field_slab(
+            coils,
+            x,
+            y,
+            z[:, :, k],
+            out[:, lo[0] :, lo[1] :, k],
+            engine,
+            tol,
+            elliptic,
+            wire_cutoff,
+        )
+        if progress is not None:
+            with lock:
+                finished[0] += 1
+                progress(finished[0], len(slabs))
+
+    slabs = [slice(k.start + lo[2], k.stop + lo[2]) for k in _slabs(region[2], step)]
+    with stage("slabs"):
+        if workers > 1:
+            # numpy and scipy.special ufuncs release the GIL, so threads
+            # writing to disjoint slabs of `out` run in parallel
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(bind(run), slabs))
+        else:
+            for k in slabs:
+                run(k)
+
+    # Mirror the evaluated region axis by axis, each pass doubling it
+    for axis in range(3):
+        if not lo[axis]:
+            continue
+        n = grid.shape[axis]
+        index = [slice(None)] + [slice(start, None) for start in lo]
+        index[axis + 1] = slice(None)
+        region = out[tuple(index)]
+        target = [slice(None)] * 4
+        target[axis + 1] = slice(0, lo[axis])
+        source = [slice(None)] * 4
+        source[axis + 1] = slice(n - 1, n - 1 - lo[axis], -1)
+        with stage("mirror"):
+            for c, sign in enumerate(symmetries[axis]):
+                np.multiply(
+                    region[c][tuple(source[1:])],
+                    sign,
+                    out=region[c][tuple(target[1:])],
+                )
+        lo[axis] = 0
+
+    return out
+
+
+def field_at_points(
+    coils: Sequence[Coil],
+    points: np.ndarray,
+    dtype=np.float64,
+    elliptic: str = "scipy",
+    chunk_size: int = 2 ** 16,
+    wire_cutoff: float = 0.0,
+) -> np.ndarray:
+    """Magnetic field at arbitrary points
+
+    The points are processed in chunks of `chunk_size` so the scratch memory
+    stays bounded however many points are queried.
+
+    Args:
+        coils (Sequence[Coil]): coils contributing to the field
+        points (np.ndarray): query points with shape (N, 3)
+        dtype (optional): precision of the computation. Defaults to np.float64.
+        elliptic (str, optional): elliptic integral backend.
+            Defaults to "scipy".
+        chunk_size (int, optional): points per kernel call. Defaults to 2**16.
+        wire_cutoff (float, optional): wire thickness as a fraction of the
+            radius, see `CoilSet`. Defaults to 0.
+
+    Returns:
+        np.ndarray: B with shape (N, 3)
+    """
+    points = np.asarray(points)
+    if points.ndim != 2 or points.shape[1] != 3:
+        raise ValueError(f"Points must have shape (N, 3), got {points.shape}")
+    coilset = CoilSet(coils, elliptic, wire_cutoff)
+    out = np.zeros(points.shape, dtype=dtype)
+    for i in range(0, len(points), chunk_size):
+        p = points[i : i + chunk_size]
+        # Write straight into the (3, n) transposed view of the output
+        coilset.field(p[:, 0], p[:, 1], p[:, 2], out=out[i : i + chunk_size].T)
+    return out
+
+
+def iter_field_at_points(
+    coils: Sequence[Coil],
+    chunks: Iterable[np.ndarray],
+    dtype=np.float64,
+    elliptic: str = "scipy",
+    chunk_size: int = 2 ** 16,
+    wire_cutoff: float = 0.0,
+) -> Iterator[np.ndarray]:
+    """Stream the field for an iterable of (n_i, 3) point chunks
+
+    Chunks are consumed lazily and one field chunk (n_i, 3) is yielded per
+    input chunk, so arbitrarily many points, e.g. read from disk or generated
+    along a trajectory, can be processed with bounded memory.
+    """
+    for points in chunks:
+        yield field_at_points(coils, points, dtype, elliptic, chunk_size, wire_cutoff)
+
+
+def canonical_form(
+    coils: Sequence[Coil], grid: Grid, digits: int = 14
+) -> Tuple[List[Coil], Grid, float]:
+    """Reduce a configuration to unit length and current scales
+
+    B is linear in the currents, and scaling every length (radii, centres
+    and grid) by s scales B by 1/s, so
+
+        B(coils, grid) = factor * B(canonical coils, canonical grid)
+
+    with the canonical configuration having a largest radius and a largest
+    current of 1. Configurations differing only by size or current share the
+    same canonical form, e.g. every radius and current of `coil_pair` on
+    `Grid.for_radius`. The canonical values are rounded to `digits`
+    significant digits so that they can be compared and hashed.
+
+    Returns:
+        Tuple[List[Coil], Grid, float]: canonical coils, canonical grid and
+        the factor to scale the canonical field by
+    """
+    s = max((abs(c.radius) for c in coils), default=0.0)
+    currents = [c.current for c in coils]
+    current = max(currents, key=abs, default=0.0)
+    if s < 1e-10 or abs(current) < 1e-10:
+        return list(coils), grid, 1.0
+
+    def r(value: float) -> float:
+        return float(f"{value / s:.{digits}g}")
+
+    canonical = [
+        Coil(
+            r(c.radius),
+            float(f"{c.current / current:.{digits}g}"),
+            centre=[r(x) for x in c.centre],
+            axis=c.axis,
+        )
+        for c in coils
+    ]
+    spacing = grid.sp if complex(grid.sp).imag != 0 else r(grid.sp)
+    canonical_grid = Grid(r(grid.Lx), r(grid.Ly), r(grid.Lz), spacing)
+
+    return canonical, canonical_grid, current / s
+
+
+class CanonicalFields(object):
+    def __init__(self, max_entries: int = 4, max_bytes: float = 512 * 2 ** 20) -> None:
+        """In-memory LRU store of canonical fields, see `canonical_form`
+
+        Fields of configurations that only differ from a stored one by their
+        size or current are derived by a single array multiply instead of a
+        full evaluation. Computations with a `memory_limit` and fields larger
+        than `max_bytes` are not stored, they are computed straight into the
+        output so that memory stays at a single field. The store is shared
+        between threads.
+
+        Args:
+            max_entries (int, optional): number of canonical fields to keep.
+                Defaults to 4.
+            max_bytes (float, optional): size cap of the stored fields.
+                Defaults to 512 MiB.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.fields = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        with self._lock:
+            return sum(B.nbytes for B in self.fields.values())
+
+    def compute(
+        self,
+        coils: Sequence[Coil],
+        grid: Grid,
+        dtype=np.float64,
+        engine: str = "direct",
+        tol: float = 1e-3,
+        elliptic: str = "scipy",
+        out: Optional[np.ndarray] = None,
+        wire_cutoff: float = 0.0,
+        **kwargs,
+    ) -> np.ndarray:
+        """Same as `compute_field`, reusing stored canonical fields
+
+        The stored field is rescaled into `out` if given, e.g. an array from
+        `point_order_field`, so a layout change costs no extra copy.
+        """
+        canonical, canonical_grid, factor = canonical_form(coils, grid)
+        key = (
+            repr(canonical),
+            (canonical_grid.Lx, canonical_grid.Ly, canonical_grid.Lz),
+            complex(canonical_grid.sp),
+            np.dtype(dtype).name,
+            engine,
+            tol,
+            elliptic,
+            # A fraction of the radius, so it is the same for every scale
+            wire_cutoff,
+        )
+        with self._lock:
+            B = self.fields.get(key)
+            if B is not None:
+                self.fields.move_to_end(key)
+
+        if B is None:
+            nbytes = 3 * np.prod(grid.shape) * np.dtype(dtype).itemsize
+            retain = kwargs.get("memory_limit") is None and nbytes <= self.max_bytes
+            B = compute_field(
+                canonical,
+                canonical_grid,
+                engine=engine,
+                tol=tol,
+                dtype=dtype,
+                elliptic=elliptic,
+                out=None if retain else out,
+                wire_cutoff=wire_cutoff,
+                **kwargs,
+            )
+            if not retain:
+                with stage("rescale"):
+                    return np.multiply(B, factor, out=B)
+            with self._lock:
+                self.fields[key] = B
+                while len(self.fields) > self.max_entries or (
+                    sum(b.nbytes for b in self.fields.values()) > self.max_bytes
+                ):
+                    self.fields.popitem(last=False)
+
+        with stage("rescale"):
+            if out is None:
+                return np.multiply(B, factor, dtype=B.dtype)
+            return np.multiply(B, factor, out=out)
+
+
+def precision_report(
+    coils: Sequence[Coil],
+    grid: Grid,
+    dtype=np.float32,
+    engine: str = "direct",
+    tol: float = 1e-3,
+    samples: int = 8,
+    elliptic: str = "scipy",
+    wire_cutoff: float = 0.0,
+) -> dict:
+    """Accuracy of a reduced precision computation against float64
+
+    The field is computed in both precisions on `samples` z planes evenly
+    spread over the grid, which is enough to characterise the error without
+    computing the whole grid twice.
+
+    Returns:
+        dict: max and rms absolute error, and the max error relative to the
+        peak field of the sampled planes
+    """
+    x, y, z = grid.get_grid("sparse")
+    k = np.unique(np.linspace(0, z.shape[2] - 1, samples).round().astype(int))
+    shape = (3, x.shape[0], y.shape[1], len(k))
+    ref = _field_slab(
+        coils, x, y, z[:, :, k], np.zeros(shape), engine, tol, elliptic, wire_cutoff
+    )
+    low = _field_slab(
+        coils,
+        x,
+        y,
+        z[:, :, k],
+        np.zeros(shape, dtype=dtype),
+        engine,
+        tol,
+        elliptic,
+        wire_cutoff,
+    )
+    error = np.abs(low.astype(np.float64) - ref)
+    peak = max(np.abs(ref).max(), 1e-300)
+
+    return {
+        "dtype": np.dtype(dtype).name,
+        "max_abs_error": float(error.max()),
+        "rms_abs_error": float(np.sqrt(np.mean(error ** 2))),
+        "max_rel_error": float(error.max() / peak),
+    }
+
+
+def multipole_report(
+    coils: Sequence[Coil],
+    grid: Grid,
+    tol: float = 1e-3,
+    samples: int = 8,
+    elliptic: str = "scipy",
+    wire_cutoff: float = 0.0,
+) -> dict:
+    """Accuracy and coverage of the "multipole" engine against "direct"
+
+    Compares both engines on `samples` z planes evenly spread over the grid,
+    as `precision_report` does.
+
+    Returns:
+        dict: far-field radius of every coaxial group, fraction of the
+        sampled points evaluated by an expansion, the truncation error bound
+        for any point and the max error measured on the sampled planes, both
+        relative to the peak field pi |I| / R at a coil centre
+    """
+    x, y, z = grid.get_grid("sparse")
+    k = np.unique(np.linspace(0, z.shape[2] - 1, samples).round().astype(int))
+    shape = (3, x.shape[0], y.shape[1], len(k))
+    ref = _field_slab(
+        coils, x, y, z[:, :, k], np.zeros(shape), "direct", tol, elliptic, wire_cutoff
+    )
+    B, _ = hybrid_field(
+        coils,
+        x,
+        y,
+        z[:, :, k],
+        np.zeros(shape),
+        tol,
+        elliptic,
+        wire_cutoff=wire_cutoff,
+    )
+    scale = max(np.pi * abs(c.current) / abs(c.radius) for c in coils)
+
+    groups = coaxial_multipoles(coils, tol)
+    far = np.zeros(shape[1:], dtype=bool)
+    for _, centre, _, _, r_far in groups:
+        r2 = (x - centre[0]) ** 2 + (y - centre[1]) ** 2 + (z[:, :, k] - centre[2]) ** 2
+        far |= r2 >= r_far ** 2
+    bound = sum(multipole.error_bound(r_far) for _, _, _, multipole, r_far in groups)
+
+    return {
+        "far_field_radius": [float(g[4]) for g in groups],
+        "far_fraction": float(far.mean()),
+        "max_rel_error_bound": bound / scale,
+        "max_rel_error": float(np.abs(B - ref).max() / scale),
+    }
+
+
+def magnetic_field_single_coil(
+    x: np.ndarray,
+    y: np.ndarray,
+    z: np.ndarray,
+    radius: float,
+    current: float,
+    centre: np.array = np.array([0.0, 0.0, 0.0]),
+    scale: np.array = np.array([1.0, 1.0, 1.0]),
+    normalise: bool = False,
+    wire_cutoff: float = 0.0,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Calculate the magnetic field of a single coil loop
+
+    The equations in Cylindrical coordinates are given by:
+    .. math::
+    B_z = \frac{\mu_0I}{2\pi}\frac{1}{[(R + \rho)^2 + z^2]^{1/2}} \times
+        \left[K(k^2)+\frac{R^2 - \rho^2 - z^2}{(R-\rho)^2 + z^2}E(k^2)\right]
+    B_\rho = \frac{\mu_0I}{2\pi\rho} \frac{z}{[R+\rho)^2 +z^2]^{1/2}} \times
+        \left[-K(k^2) + E(k^2)\frac{R^2+\rho^2+z^2}{(R-\rho)^2+z^2}\right]
+
+    where K and E are the elliptic integrals, evaluated by `loop_field`, so
+    the field is finite everywhere: exact on the axis and zero on the wire.
+
+    Args:
+        x (np.ndarray): generated by `np.mgrid`
+        y (np.ndarray): generated by `np.mgrid`
+        z (np.ndarray): generated by `np.mgrid`
+        radius (float): radius of the coil
+        current (float): current through the coil
+        normalise (bool, optional): normalise field. Defaults to False.
+        wire_cutoff (float, optional): distance from the wire within which
+            the field is zero, as a fraction of the radius. Defaults to 0.0.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, np.ndarray]: Magnetic field in Cartesian coordinates
+    """
+    x = (x - centre[0]) * scale[0]
+    y = (y - centre[1]) * scale[1]
+    z = (z - centre[2]) * scale[2]
+
+    rho2 = x ** 2 + y ** 2
+    Bz, rho_Brho = loop_field(rho2, z, radius, current, wire_cutoff)
+
+    # x / rho^2 and y / rho^2 turn rho * Brho into Bx and By, on the axis
+    # Brho vanishes so any finite value does
+    inv_rho2 = np.zeros_like(rho_Brho)
+    np.divide(1.0, rho2, out=inv_rho2, where=np.broadcast_to(rho2, inv_rho2.shape) > 0)
+    if normalise:
+        mu = 4 * np.pi * 10.0 ** (-7)  # μ0 constant
+        Bz *= mu / (2 * np.pi)
+        rho_Brho *= mu / (2 * np.pi) * np.sqrt(inv_rho2)
+
+    B = np.array([x * inv_rho2 * rho_Brho, y * inv_rho2 * rho_Brho, Bz])
+    del rho_Brho, inv_rho2
+
+    return B
+
+
+def coil_field_cylindrical(
+    rho: np.ndarray,
+    z: np.ndarray,
+    radius: float,
+    current: float,
+    normalise: bool = False,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Magnetic field of a single coil loop in cylindrical coordinates
+
+    Same equations as `magnetic_field_single_coil` but evaluated directly
+    on (rho, z) relative to the coil centre, which is all the field of an
+    axisymmetric loop depends on.
+
+    Args:
+        rho (np.ndarray): radial distance from the coil axis
+        z (np.ndarray): axial distance from the coil plane
+        radius (float): radius of the coil
+        current (float): current through the coil
+        normalise (bool, optional): normalise field. Defaults to False.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Brho, Bz
+    """
+    rho = np.asarray(rho, dtype=float)
+    Bz, rho_Brho = loop_field(rho ** 2, z, radius, current)
+
+    # Brho vanishes on the axis
+    inv_rho = np.zeros_like(rho_Brho)
+    np.divide(1.0, rho, out=inv_rho, where=np.broadcast_to(rho, inv_rho.shape) > 0)
+    Brho = np.multiply(rho_Brho, inv_rho, out=rho_Brho)
+    if normalise:
+        mu = 4 * np.pi * 10.0 ** (-7)  # μ0 constant
+        Bz *= mu / (2 * np.pi)
+        Brho *= mu / (2 * np.pi) * inv_rho
+
+    return Brho, Bz
+
+
+def magnetic_field_single_coil_table(
+    x: np.ndarray,
+    y: np.ndarray,
+    z: np.ndarray,
+    radius: float,
+    current: float,
+    centre: np.array = np.array([0.0, 0.0, 0.0]),
+    scale: np.array = np.array([1.0, 1.0, 1.0]),
+    normalise: bool = False,
+    tol: float = 1e-3,
+    error_cutoff: float = 0.1,
+    max_nodes: int = 1025,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Calculate the magnetic field of a single coil loop via a lookup table
+
+    The field of a loop only depends on (rho, z) relative to its centre,
+    so the elliptic integrals are evaluated once on a 2D table covering
+    the extent of the grid and then interpolated onto the 3D points. For
+    a sparse grid of n^3 points the special functions are evaluated
+    O(n^2) times instead of O(n^3). With `np.ogrid` inputs the table uses
+    the grid's z values as nodes and is only interpolated in rho, for any
+    other layout it is a uniform table interpolated bilinearly.
+
+    The table resolution in rho is doubled until the interpolation error at the
+    cell midpoints, relative to the peak field, is below `tol`. The field
+    diverges on the wire itself, so midpoints closer to the wire than
+    `error_cutoff * radius` are excluded from the error estimate. This does
+    not change the field near the wire, unlike the `wire_cutoff` of `CoilSet`.
+
+    Args:
+        x (np.ndarray): generated by `np.ogrid` or `np.mgrid`
+        y (np.ndarray): generated by `np.ogrid` or `np.mgrid`
+        z (np.ndarray): generated by `np.ogrid` or `np.mgrid`
+        radius (float): radius of the coil
+        current (float): current through the coil
+        normalise (bool, optional): normalise field. Defaults to False.
+        tol (float, optional): relative error tolerance. Defaults to 1e-3.
+        error_cutoff (float, optional): distance from the wire excluded
+            from the error estimate, as a fraction of the radius.
+            Defaults to 0.1.
+        max_nodes (int, optional): max table nodes per axis. Defaults to 1025.
+        out (np.ndarray, optional): buffer of shape (3, *grid) to add the
+            field to. Defaults to a new zeroed array.
+
+    Returns:
+        np.ndarray: Magnetic field in Cartesian coordinates
+    """
+    x = (x - centre[0]) * scale[0]
+    y = (y - centre[1]) * scale[1]
+    z = (z - centre[2]) * scale[2]
+    rho = np.sqrt(x ** 2 + y ** 2)
+
+    rho_max = max(float(rho.max()), 1e-10)
+    # For `np.ogrid` grids z only varies along the last axis and rho is
+    # constant along it, so the table can be built on the grid's own z
+    # values and only needs interpolating in rho
+    z_exact = (
+        np.ndim(z) == np.ndim(rho) > 0
+        and np.shape(rho)[-1] == 1
+        and np.size(z) == np.shape(z)[-1]
+    )
+    if z_exact:
+        z_t = np.ravel(z)[None, :]
+    else:
+        z_min, z_max = float(z.min()), float(z.max())
+        if z_max - z_min < 1e-10:
+            z_min, z_max = z_min - 1e-10, z_max + 1e-10
+
+    nodes = 33
+    while True:
+        rho_t = np.linspace(0, rho_max, nodes)[:, None]
+        if not z_exact:
+            z_t = np.linspace(z_min, z_max, nodes)[None, :]
+        table = np.stack(
+            coil_field_cylindrical(
+                rho_t, z_t, radius, current, normalise
+            )
+        )
+
+        # Linear interpolation is least accurate at the cell centres
+        rho_mid = 0.5 * (rho_t[1:] + rho_t[:-1])
+        if z_exact:
+            z_mid = z_t
+            interp = 0.5 * (table[:, :-1] + table[:, 1:])
+        else:
+            z_mid = 0.5 * (z_t[:, 1:] + z_t[:, :-1])
+            interp = 0.25 * (
+                table[:, :-1, :-1]
+                + table[:, 1:, :-1]
+                + table[:, :-1, 1:]
+                + table[:, 1:, 1:]
+            )
+        exact = np.stack(
+            coil_field_cylindrical(
+                rho_mid, z_mid, radius, current, normalise
+            )
+        )
+        far = (rho_mid - abs(radius)) ** 2 + z_mid ** 2 > (
+            error_cutoff * abs(radius)
+        ) ** 2
+        peak = max(np.abs(exact[:, far]).max(initial=0), 1e-300)
+        error = np.abs(interp - exact)[:, far].max(initial=0) / peak
+        if error <= tol:
+            break
+        if 2 * nodes - 1 > max_nodes:
+            warnings.warn(
+                f"Lookup table reached {nodes} rho nodes with relative"
+                f" error {error:.2e} > tol={tol:.2e}"
+            )
+            break
+        nodes = 2 * nodes - 1
+
+    shape = np.broadcast(x, y, z).shape
+    if out is None:
+        out = np.zeros((3,) + shape)
+    # Directions of Brho, on the axis Brho vanishes so pick any direction
+    rho_safe = np.where(rho > 0, rho, 1.0)
+    directions = (x / rho_safe, y / rho_safe)
+
+    if z_exact:
+        _interpolate_table_rho(
+            table.astype(out.dtype), rho_max / (nodes - 1), rho, directions, out
+        )
+        return out
+
+    Brho, Bz = _interpolate_table(
+        table,
+        rho_max / (nodes - 1),
+        z_min,
+        (z_max - z_min) / (nodes - 1),
+        rho,
+        z,
+    )
+    for c, direction in enumerate(directions):
+        out[c] += direction * Brho
+    out[2] += Bz
+    return out
+
+
+def _interpolate_table_rho(
+    table: np.ndarray,
+    drho: float,
+    rho: np.ndarray,
+    directions: Tuple[np.ndarray, np.ndarray],
+    out: np.ndarray,
+) -> np.ndarray:
+    """Add a (components, rho, z) table interpolated linearly in rho to `out`
+
+    `rho` and the radial `directions` must be constant along their last
+    axis, the z nodes of the table being the values along that axis. The
+    indices and weights are computed on that (x, y) plane, each value is
+    then a gather of whole z rows of the table plus a weighted gather of
+    their differences, written with two work arrays of the slab's size.
+    """
+    nrho = table.shape[1]
+
+    fr = rho[..., 0] / drho
+    i = np.clip(np.floor(fr).astype(np.intp), 0, nrho - 2)
+    wr = (fr - i)[..., None].astype(out.dtype)
+    slope = np.diff(table, axis=1)
+
+    value = np.empty(out.shape[1:], dtype=out.dtype)
+    tmp = np.empty_like(value)
+
+    def interpolate(c: int) -> np.ndarray:
+        # "clip" avoids the buffered copy of the default mode with `out`
+        np.take(table[c], i, axis=0, out=value, mode="clip")
+        np.take(slope[c], i, axis=0, out=tmp, mode="clip")
+        np.multiply(tmp, wr, out=tmp)
+        return np.add(value, tmp, out=value)
+
+    Brho = interpolate(0)
+    for k, direction in enumerate(directions):
+        np.multiply(Brho, direction.astype(out.dtype), out=tmp)
+        out[k] += tmp
+    out[2] += interpolate(1)
+    return out
+
+
+def _interpolate_table(
+    table: np.ndarray,
+    drho: float,
+    z0: float,
+    dz: float,
+    rho: np.ndarray,
+    z: np.ndarray,
+) -> np.ndarray:
+    """Bilinear interpolation of a (components, rho, z) table
+
+    `rho` and `z` may be sparse (broadcastable) arrays, in which case the
+    indices and weights are computed on the sparse arrays and only the
+    final gather is done on the full broadcast shape.
+    """
+    nrho, nz = table.shape[1:]
+
+    fr = rho / drho
+    i = np.clip(np.floor(fr).astype(np.intp), 0, nrho - 2)
+    wr = fr - i
+    fz = (z - z0) / dz
+    j = np.clip(np.floor(fz).astype(np.intp), 0, nz - 2)
+    wz = fz - j
+
+    return (
+        table[:, i, j] * ((1 - wr) * (1 - wz))
+        + table[:, i + 1, j] * (wr * (1 - wz))
+        + table[:, i, j + 1] * ((1 - wr) * wz)
+        + table[:, i + 1, j + 1] * (wr * wz)
+    )
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Compute the magnetic field of a coil set without a GUI"
+    )
+    parser.add_argument(
+        "--configuration",
+        choices=sorted(CONFIGURATIONS),
+        default="pair",
+        help="coil configuration",
+    )
+    parser.add_argument("--radius", type=float, default=1.0, help="coil radius R")
+    parser.add_argument("--current", type=float, default=1.0, help="current I")
+    parser.add_argument(
+        "--spacing", type=int, default=50, help="number of points per axis"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=("direct", "table", "multipole"),
+        default="direct",
+        help="field engine",
+    )
+    parser.add_argument(
+        "--elliptic",
+        choices=("scipy", "agm"),
+        default="scipy",
+        help="elliptic integral backend of the direct engine",
+    )
+    parser.add_argument(
+        "--tol",
+        type=float,
+        default=1e-3,
+        help="tolerance of the table and multipole engines",
+    )
+    parser.add_argument(
+        "--wire-cutoff",
+        type=float,
+        default=0.0,
+        help="zero the field within this fraction of the radius from the wires",
+    )
+    parser.add_argument(
+        "--memory-limit",
+        type=float,
+        default=None,
+        help="scratch memory budget in MB, the grid is computed in z-slabs",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of threads, 0 uses all cores",
+    )
+    parser.add_argument(
+        "--symmetry",
+        action="store_true",
+        help="only evaluate the fundamental region of mirror symmetric setups",
+    )
+    parser.add_argument(
+        "--float32", action="store_true", help="compute and store in float32"
+    )
+    parser.add_argument(
+        "--precision-report",
+        action="store_true",
+        help="print the accuracy of the chosen precision against float64",
+    )
+    parser.add_argument(
+        "--cache",
+        metavar="DIR",
+        default=None,
+        help="reuse and store fields in an on-disk cache directory",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="JSON",
+        default=None,
+        help="write per-stage timings and memory peaks to a JSON file",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write a .npy slab by slab as it is computed, implied by .vti",
+    )
+    parser.add_argument(
+        "--magnitude",
+        action="store_true",
+        help="also store |B| when streaming, see field_export",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="B.npz",
+        help=".npy stores only B, .npz also stores the grid axes and coils,"
+        " .vti is VTK image data for ParaView",
+    )
+    args = parser.parse_args(argv)
+    stream = args.stream or args.output.endswith(".vti")
+    if stream and (args.cache is not None or args.symmetry):
+        parser.error("--cache and --symmetry need the whole field in memory")
+    if stream and not args.output.endswith((".npy", ".vti")):
+        parser.error("streaming writes .npy or .vti files")
+    if args.wire_cutoff and args.engine == "table":
+        parser.error("the table engine does not support --wire-cutoff")
+
+    coils = CONFIGURATIONS[args.configuration](args.radius, args.current)
+    grid = Grid.for_radius(args.radius, args.spacing * 1j)
+    dtype = np.float32 if args.float32 else np.float64
+    memory_limit = None
+    if args.memory_limit is not None:
+        memory_limit = args.memory_limit * 2 ** 20
+    compute = compute_field
+    if args.cache is not None:
+        from field_cache import FieldCache
+
+        compute = FieldCache(args.cache).compute
+    profiler = Profiler(memory=True)
+    if stream:
+        from field_export import EXPORT_MEMORY_LIMIT, export_field
+
+        with profiler.run("export_field", **vars(args)):
+            export_field(
+                coils,
+                grid,
+                args.output,
+                engine=args.engine,
+                tol=args.tol,
+                dtype=dtype,
+                memory_limit=memory_limit or EXPORT_MEMORY_LIMIT,
+                workers=args.workers or None,
+                elliptic=args.elliptic,
+                magnitude=args.magnitude,
+                wire_cutoff=args.wire_cutoff,
+            )
+    else:
+        with profiler.run("compute_field", **vars(args)):
+            B = compute(
+                coils,
+                grid,
+                engine=args.engine,
+                tol=args.tol,
+                dtype=dtype,
+                memory_limit=memory_limit,
+                workers=args.workers or None,
+                elliptic=args.elliptic,
+                symmetry=args.symmetry,
+                wire_cutoff=args.wire_cutoff,
+            )
+    if args.profile is not None:
+        profiler.to_json(args.profile)
+        print(Profiler.summary(profiler.last, depth=0))
+    if args.precision_report:
+        report = precision_report(
+            coils,
+            grid,
+            dtype,
+            args.engine,
+            args.tol,
+            elliptic=args.elliptic,
+            wire_cutoff=args.wire_cutoff,
+        )
+        print(json.dumps(report, indent=2))
+    if args.engine == "multipole":
+        report = multipole_report(
+            coils, grid, args.tol, elliptic=args.elliptic, wire_cutoff=args.wire_cutoff
+        )
+        print(json.dumps(report, indent=2))
+
+    if stream:
+        return
+    if args.output.endswith(".npy"):
+        np.save(args.output, B)
+    else:
+        x, y, z = grid.get_grid("sparse")
+        np.savez(
+            args.output,
+            B=B,
+            x=np.ravel(x),
+            y=np.ravel(y),
+            z=np.ravel(z),
+            radius=[c.radius for c in coils],
+            current=[c.current for c in coils],
+            centre=[c.centre for c in coils],
+            axis=[c.axis for c in coils],
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Streaming export of computed fields to VTK and raw binary files
+
+The field is computed one z-slab at a time by `iter_field_slabs` and every
+slab is written out as soon as it is finished, so only a few slabs are ever
+resident and fields larger than memory can be handed to ParaView or to
+downstream analysis::
+
+    python field_compute.py --spacing 500 --magnitude -o B.vti
+
+The format follows from the extension of the output path:
+
+- `.vti`: VTK XML image data with the raw binary arrays in the appended
+  section, B as point vectors and optionally |B| as point scalars.
+- `.npy`: B with shape (3, nx, ny, nz) stored in point order (Fortran order
+  in the header), so `np.load(path, mmap_mode="r")` maps it without reading
+  it and hands z-slabs out as contiguous runs of the file. |B| is stored
+  next to it as `<name>_magnitude.npy`.
+
+Both are written to temporary files first, an interrupted export leaves no
+partial output behind.
+"""
+import os
+import sys
+from abc import ABC, abstractmethod
+import threading
+from typing import Callable, Optional, Sequence
+import numpy as np
+
+from field_compute import Coil, ComputationCancelled, Grid, iter_field_slabs
+from instrumentation import stage
+
+# Scratch memory budget per slab when none is given
+EXPORT_MEMORY_LIMIT = 256 * 2 ** 20
+
+_VTK_TYPES = {"float32": "Float32", "float64": "Float64"}
+
+
+def magnitude_path(path: str) -> str:
+    """Path of the |B| array of a `.npy` export"""
+    return f"{os.path.splitext(path)[0]}_magnitude.npy"
+
+
+def _magnitude(B: np.ndarray) -> np.ndarray:
+    """|B| of a point order slab, in point order"""
+    Bt = B.T
+    out = np.einsum("...i,...i->...", Bt, Bt)
+    return np.sqrt(out, out=out)
+
+
+class SlabWriter(ABC):
+    def __init__(self, path: str, grid: Grid, dtype, magnitude: bool = False) -> None:
+        """Writes a field slab by slab, in increasing z
+
+        Use as a context manager: the output only replaces `path` when the
+        block finishes without an error, otherwise it is removed.
+
+        Args:
+            path (str): output file
+            grid (Grid): grid of the field
+            dtype (optional): dtype of the stored arrays
+            magnitude (bool, optional): also store |B|. Defaults to False.
+        """
+        self.path = path
+        self.grid = grid
+        self.dtype = np.dtype(dtype)
+        self.magnitude = magnitude
+        self._files = {}  # final path: open temporary file
+
+    def _open(self, path: str):
+        f = open(f"{path}.{os.getpid()}.tmp", "wb")
+        self._files[path] = f
+        return f
+
+    def _close(self, keep: bool) -> None:
+        for path, f in self._files.items():
+            f.close()
+            if keep:
+                os.replace(f.name, path)
+            else:
+                os.remove(f.name)
+        self._files = {}
+
+    def __enter__(self) -> "SlabWriter":
+        try:
+            self.open()
+        except BaseException:
+            # __exit__ is not called when __enter__ raises
+            self._close(keep=False)
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._close(keep=exc_type is None)
+
+    @abstractmethod
+    def open(self) -> None:
+        """Create the temporary files and write their headers"""
+
+    @abstractmethod
+    def write(self, B: np.ndarray) -> None:
+        """Append the next slab, B with shape (3, nx, ny, nz_slab)"""
+
+
+class VTKImageWriter(SlabWriter):
+    def open(self) -> None:
+        nx, ny, nz = self.grid.shape
+        points = nx * ny * nz
+        vtk_type = _VTK_TYPES[self.dtype.name]
+        extent = f"0 {nx - 1} 0 {ny - 1} 0 {nz - 1}"
+        origin = " ".join(repr(float(v)) for v in self.grid.origin)
+        spacing = " ".join(repr(float(v)) for v in self.grid.step)
+        # Every appended array is its size as UInt64 followed by the values
+        self.vectors_bytes = 3 * points * self.dtype.itemsize
+        scalars_offset = 8 + self.vectors_bytes
+        byte_order = "LittleEndian" if sys.byteorder == "little" else "BigEndian"
+
+        arrays = [
+            f'<DataArray type="{vtk_type}" Name="B" NumberOfComponents="3"'
+            ' format="appended" offset="0"/>'
+        ]
+        scalars = ""
+        if self.magnitude:
+            scalars = ' Scalars="|B|"'
+            arrays.append(
+                f'<DataArray type="{vtk_type}" Name="|B|" format="appended"'
+                f' offset="{scalars_offset}"/>'
+            )
+        header = "\n".join(
+            [
+                '<?xml version="1.0"?>',
+                '<VTKFile type="ImageData" version="1.0"'
+                f' byte_order="{byte_order}" header_type="UInt64">',
+                f'<ImageData WholeExtent="{extent}" Origin="{origin}"'
+                f' Spacing="{spacing}">',
+                f'<Piece Extent="{extent}">',
+                f'<PointData Vectors="B"{scalars}>',
+                *arrays,
+                "</PointData>",
+                "</Piece>",
+                "</ImageData>",
+                '<AppendedData encoding="raw">',
+                "_",
+            ]
+        )
+
+        f = self._open(self.path)
+        f.write(header.encode("ascii"))
+        self._vectors = f.tell()
+        f.write(np.uint64(self.vectors_bytes).tobytes())
+        self._vectors += 8
+        if self.magnitude:
+            # Sized up front, so both arrays are filled in as slabs arrive
+            self._scalars = self._vectors + self.vectors_bytes
+            f.seek(self._scalars)
+            f.write(np.uint64(points * self.dtype.itemsize).tobytes())
+            self._scalars += 8
+            f.seek(self._scalars + points * self.dtype.itemsize)
+        else:
+            f.seek(self._vectors + self.vectors_bytes)
+        f.write(b"\n</AppendedData>\n</VTKFile>\n")
+
+    def write(self, B: np.ndarray) -> None:
+        f = self._files[self.path]
+        B = B.astype(self.dtype, copy=False)
+        f.seek(self._vectors)
+        # In point order a slab is a contiguous run of the array
+        f.write(np.ascontiguousarray(B.T).data)
+        self._vectors = f.tell()
+        if self.magnitude:
+            f.seek(self._scalars)
+            f.write(_magnitude(B).data)
+            self._scalars = f.tell()
+
+
+class NpyWriter(SlabWriter):
+    def open(self) -> None:
+        nx, ny, nz = self.grid.shape
+        arrays = [(self.path, (3, nx, ny, nz))]
+        if self.magnitude:
+            arrays.append((magnitude_path(self.path), (nx, ny, nz)))
+        for path, shape in arrays:
+            # Fortran order of (3, nx, ny, nz) is point order
+            header = {
+                "descr": np.lib.format.dtype_to_descr(self.dtype),
+                "fortran_order": True,
+                "shape": shape,
+            }
+            np.lib.format.write_array_header_1_0(self._open(path), header)
+
+    def write(self, B: np.ndarray) -> None:
+        B = B.astype(self.dtype, copy=False)
+        self._files[self.path].write(np.ascontiguousarray(B.T).data)
+        if self.magnitude:
+            self._files[magnitude_path(self.path)].write(_magnitude(B).data)
+
+
+WRITERS = {".vti": VTKImageWriter, ".npy": NpyWriter}
+
+
+def export_field(
+    coils: Sequence[Coil],
+    grid: Grid,
+    path: str,
+    engine: str = "direct",
+    tol: float = 1e-3,
+    dtype=np.float64,
+    memory_limit: Optional[float] = EXPORT_MEMORY_LIMIT,
+    workers: Optional[int] = 1,
+    elliptic: str = "scipy",
+    magnitude: bool = False,
+    progress: Optional[Callable[[int, int], None]] = None,
+    cancel: Optional[threading.Event] = None,
+    wire_cutoff: float = 0.0,
+) -> str:
+    """Compute the field of `coils` on `grid` and stream it to a file
+
+    Args:
+        coils (Sequence[Coil]): coils contributing to the field
+        grid (Grid): grid to evaluate the field on
+        path (str): output file, ".vti" or ".npy", see the module docstring
+        engine (str, optional): field engine, see `compute_field`.
+            Defaults to "direct".
+        tol (float, optional): tolerance of the "table" and "multipole"
+            engines. Defaults to 1e-3.
+        dtype (optional): precision of the computation and of the file.
+            Defaults to np.float64.
+        memory_limit (float, optional): scratch memory budget in bytes per
+            slab, which also sets the slab size. None computes the whole
+            grid as one slab. Defaults to `EXPORT_MEMORY_LIMIT`.
+        workers (int, optional): threads, each holding one slab, None uses
+            all cores. Defaults to 1.
+        elliptic (str, optional): elliptic integral backend of the "direct"
+            engine. Defaults to "scipy".
+        magnitude (bool, optional): also store |B|. Defaults to False.
+        progress (Callable[[int, int], None], optional): called with the
+            number of written and total z planes after every slab.
+            Defaults to None.
+        cancel (threading.Event, optional): checked after every slab, when
+            set the export stops by raising `ComputationCancelled` and the
+            partial output is removed. Defaults to None.
+        wire_cutoff (float, optional): wire thickness as a fraction of the
+            radius, see `compute_field`. Defaults to 0.
+
+    Returns:
+        str: `path`
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError(
+            f"Export format: {extension} not supported, use one of {sorted(WRITERS)}"
+        )
+    nz = grid.shape[2]
+    with WRITERS[extension](path, grid, dtype, magnitude) as writer:
+        slabs = iter_field_slabs(
+            coils,
+            grid,
+            engine,
+            tol,
+            dtype,
+            memory_limit,
+            elliptic,
+            workers=workers,
+            point_order=True,
+            wire_cutoff=wire_cutoff,
+        )
+        with stage("slabs"):
+            for k, B in slabs:
+                with stage("write"):
+                    writer.write(B)
+                if progress is not None:
+                    progress(k.stop, nz)
+                if cancel is not None and cancel.is_set():
+                    slabs.close()
+                    raise ComputationCancelled()
+    return path
@@ -0,0 +1,283 @@
+"""Per-stage timing and memory instrumentation
+
+Code paths mark their stages with the `stage` context manager, which costs
+a single thread-local lookup while no profiler is active::
+
+    with stage("elliptic") as s:
+        s.array("m", m)
+        ...
+
+A `Profiler` collects the stages of everything executed inside its `run`
+context on the same thread, and on worker threads running functions wrapped
+with `bind`, and keeps one record per run with the wall time, call count,
+peak of the memory allocated on top of what was in use when the stage
+started (through `tracemalloc`, which numpy reports its arrays to) and the
+shape and size of the arrays a stage registered. Stages may nest, a stage's
+time includes that of its children and stages running on worker threads add
+up their thread time. Runs on different threads are recorded separately,
+even by the same profiler. `tracemalloc` has a single process-wide peak, so
+memory is only traced by one run at a time, a run starting while another
+one traces memory records no memory peaks.
+"""
+import functools
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+import numpy as np
+
+# Run collecting the stages of each thread, unset when instrumentation is off
+_active = threading.local()
+# Held by the run tracing memory
+_tracing_lock = threading.Lock()
+
+
+class _Stage(object):
+    def __init__(self, name: str, current: int = 0) -> None:
+        self.name = name
+        self.path = name  # names of the enclosing stages and this one
+        self.current = current  # traced memory at the start of the stage
+        self.peak = current
+        self.arrays = {}
+        self.start = time.perf_counter()
+
+    def array(self, name: str, a: np.ndarray) -> None:
+        """Record the shape, dtype and size of an array used by the stage"""
+        self.arrays[name] = {
+            "shape": list(np.shape(a)),
+            "dtype": np.asarray(a).dtype.name,
+            "nbytes": int(np.asarray(a).nbytes),
+        }
+
+
+class _NullStage(object):
+    def array(self, name: str, a: np.ndarray) -> None:
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[_Stage]:
+    """Record a stage in the run active on this thread, if any"""
+    run = getattr(_active, "run", None)
+    if run is None:
+        yield _NULL_STAGE
+        return
+    s = run._enter(name)
+    try:
+        yield s
+    finally:
+        run._exit(s)
+
+
+def bind(fn: Callable) -> Callable:
+    """`fn` recording its stages in the run active on this thread, if any
+
+    For functions handed to worker threads, e.g. of a `ThreadPoolExecutor`,
+    their stages nest under the stage open when `fn` is bound.
+    """
+    run = getattr(_active, "run", None)
+    if run is None:
+        return fn
+    stack = run._stack()
+    parent = stack[-1].path if stack else None
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_active, "run", None)
+        previous_parent = getattr(run._local, "parent", None)
+        _active.run = run
+        run._local.parent = parent
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _active.run = previous
+            run._local.parent = previous_parent
+
+    return wrapper
+
+
+class _Run(object):
+    def __init__(self, memory: bool) -> None:
+        """Stages of one `Profiler.run`, shared with the threads it binds"""
+        self.memory = memory
+        # Traced memory at the start of the run and the peak on top of it
+        self.base = tracemalloc.get_traced_memory()[0] if memory else 0
+        self.peak = 0
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._owner = threading.get_ident()  # only this thread traces memory
+
+    def _stack(self) -> List[_Stage]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _traces_memory(self) -> bool:
+        return self.memory and threading.get_ident() == self._owner
+
+    def _fold_peak(self, stack: List[_Stage]) -> None:
+        # tracemalloc only has a single global peak, fold it into the open
+        # stages before resetting it for the next one
+        peak = tracemalloc.get_traced_memory()[1]
+        for s in stack:
+            s.peak = max(s.peak, peak)
+        self.peak = max(self.peak, peak - self.base)
+        tracemalloc.reset_peak()
+
+    def _enter(self, name: str) -> _Stage:
+        stack = self._stack()
+        current = 0
+        if self._traces_memory():
+            self._fold_peak(stack)
+            current = tracemalloc.get_traced_memory()[0]
+        # Stages of bound worker threads nest under the stage that bound them
+        parent = stack[-1].path if stack else getattr(self._local, "parent", None)
+        s = _Stage(name, current)
+        s.path = name if parent is None else f"{parent}/{name}"
+        stack.append(s)
+
+        with self._lock:
+            if s.path not in self.stages:
+                self.stages[s.path] = {
+                    "stage": s.path,
+                    "calls": 0,
+                    "time_s": 0.0,
+                    "peak_bytes": None,
+                    "arrays": {},
+                }
+        return s
+
+    def _exit(self, s: _Stage) -> None:
+        elapsed = time.perf_counter() - s.start
+        stack = self._stack()
+        peak = None
+        if self._traces_memory():
+            self._fold_peak(stack)
+            peak = s.peak - s.current
+        stack.pop()
+
+        with self._lock:
+            entry = self.stages[s.path]
+            entry["calls"] += 1
+            entry["time_s"] += elapsed
+            if peak is not None:
+                entry["peak_bytes"] = max(entry["peak_bytes"] or 0, peak)
+            entry["arrays"].update(s.arrays)
+
+
+class Profiler(object):
+    def __init__(
+        self,
+        memory: bool = False,
+        on_run: Optional[Callable[[dict], None]] = None,
+        max_runs: int = 32,
+    ) -> None:
+        """Collector of per-stage timings, one record per `run`
+
+        Args:
+            memory (bool, optional): trace the allocation peak of every
+                stage. `tracemalloc` slows down allocation heavy Python code
+                (Mayavi more so than numpy). Defaults to False.
+            on_run (Callable[[dict], None], optional): called with the
+                record of every finished run, e.g. to update a status bar.
+                Defaults to None.
+            max_runs (int, optional): number of records to keep.
+                Defaults to 32.
+        """
+        self.memory = memory
+        self.on_run = on_run
+        self.max_runs = max_runs
+        self.runs = []
+        self._lock = threading.Lock()
+
+    @property
+    def last(self) -> Optional[dict]:
+        return self.runs[-1] if self.runs else None
+
+    @contextmanager
+    def run(self, name: str, **params) -> Iterator["Profiler"]:
+        """Collect the stages of a run, e.g. one `sphere_el` plot
+
+        Runs do not nest, an inner run on the same thread is recorded as a
+        stage of the outer.
+        """
+        if getattr(_active, "run", None) is not None:
+            with stage(name):
+                yield self
+            return
+
+        # Another thread's run may already be tracing memory
+        memory = self.memory and _tracing_lock.acquire(blocking=False)
+        started_tracing = memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        run = _active.run = _Run(memory)
+        start = time.perf_counter()
+        if memory:
+            tracemalloc.reset_peak()
+        try:
+            yield self
+        finally:
+            total = time.perf_counter() - start
+            peak = None
+            if memory:
+                run._fold_peak([])
+                peak = run.peak
+            _active.run = None
+            if started_tracing:
+                tracemalloc.stop()
+            if memory:
+                _tracing_lock.release()
+            with run._lock:
+                stages = list(run.stages.values())
+            record = {
+                "name": name,
+                "params": params,
+                "time_s": total,
+                "peak_bytes": peak,
+                "stages": stages,
+            }
+            with self._lock:
+                self.runs = (self.runs + [record])[-self.max_runs :]
+            if self.on_run is not None:
+                self.on_run(record)
+
+    def to_json(self, path: Optional[str] = None, indent: int = 2) -> str:
+        """All recorded runs as JSON, also written to `path` if given"""
+        text = json.dumps(self.runs, indent=indent)
+        if path is not None:
+            with open(path, "w") as f:
+                f.write(text)
+        return text
+
+    @staticmethod
+    def summary(record: dict, depth: int = 1) -> str:
+        """Human readable table of the stages of a run
+
+        Args:
+            record (dict): record of a run, e.g. `Profiler.last`
+            depth (int, optional): deepest stage nesting to include, 0 for
+                all. Defaults to 1, the top level stages.
+        """
+        lines = [f"{record['name']}: {record['time_s'] * 1e3:.0f} ms"]
+        if record["peak_bytes"] is not None:
+            lines[0] += f", peak {record['peak_bytes'] / 2 ** 20:.1f} MB"
+        for entry in record["stages"]:
+            level = entry["stage"].count("/")
+            if depth and level >= depth:
+                continue
+            line = (
+                f"{'  ' * (level + 1)}{entry['stage'].rsplit('/', 1)[-1]:<20}"
+                f" {entry['time_s'] * 1e3:8.1f} ms"
+            )
+            if entry["peak_bytes"] is not None:
+                line += f" {entry['peak_bytes'] / 2 ** 20:8.1f} MB"
+            lines.append(line)
+        return "\n".join(lines)
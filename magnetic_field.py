@@ -1,104 +1,861 @@
-from typing import Tuple
+import importlib
+import os
+import shutil
+import subprocess
+import threading
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
 import numpy as np
-from mayavi import mlab
-from mayavi.modules.iso_surface import IsoSurface
-from mayavi.modules.streamline import Streamline
-from scipy import special
+
+from adaptive_grid import AdaptiveGrid
+from field_cache import FieldCache
+from field_compute import (
+    CONFIGURATIONS,
+    CanonicalFields,
+    Coil,
+    ComputationCancelled,
+    Grid,
+    field_at_points,
+    iter_field_at_points,
+    point_order_field,
+)
+from field_export import EXPORT_MEMORY_LIMIT, export_field
+from field_lines import seed_points, trace_field_lines
+from instrumentation import Profiler, stage
+from waveforms import UnitFields, Waveform, frame_times
+
+if TYPE_CHECKING:
+    from mayavi.modules.iso_surface import IsoSurface
+    from mayavi.modules.streamline import Streamline
+
+
+class _LazyImport(object):
+    def __init__(self, module: str, name: Optional[str] = None, loader=None) -> None:
+        """Module, or attribute `name` of it, imported on first attribute use
+
+        `loader` is called before the import, `load_mayavi` by default.
+        """
+        self._module = module
+        self._name = name
+        self._loader = loader
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            (self._loader or load_mayavi)()
+            target = importlib.import_module(self._module)
+            if self._name is not None:
+                target = getattr(target, self._name)
+            self._target = target
+        return self._target
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+
+def load_vtk() -> None:
+    """Import VTK and tvtk, safe on any thread"""
+    if _vtk_loaded.is_set():
+        return
+    for module in _VTK_MODULES:
+        importlib.import_module(module)
+    _vtk_loaded.set()
+
+
+def load_mayavi() -> None:
+    """Import Mayavi and pyface, on the GUI thread
+
+    pyface creates the Qt application on import, which has to happen on
+    the thread that runs the GUI.
+    """
+    if _mayavi_loaded.is_set():
+        return
+    load_vtk()
+    for module in _MAYAVI_MODULES:
+        importlib.import_module(module)
+    _mayavi_loaded.set()
+
+
+# Mayavi, pyface and VTK take seconds to import (and bring up Qt), so they
+# are only imported on first use, or VTK ahead of it by `prewarm`
+mlab = _LazyImport("mayavi.mlab")
+GUI = _LazyImport("pyface.api", "GUI")
+tvtk = _LazyImport("tvtk.api", "tvtk", loader=load_vtk)
+_VTK_MODULES = ("vtk", "tvtk.api")
+_MAYAVI_MODULES = (
+    "pyface.api",
+    "mayavi.mlab",
+    "mayavi.modules.iso_surface",
+    "mayavi.modules.streamline",
+)
+_vtk_loaded = threading.Event()
+_mayavi_loaded = threading.Event()
+# Index of the widget of each seed type in `SourceWidget.widget_list`
+_SEED_WIDGETS = {"sphere": 0, "line": 1, "plane": 2}
+
+
+def mayavi_loaded() -> bool:
+    return _mayavi_loaded.is_set()
+
+
+def prewarm() -> threading.Thread:
+    """Import VTK and tvtk on a background thread
+
+    Meant to run while the user is still entering parameters, so that the
+    first plot only waits for the field. Mayavi and pyface bring up Qt and
+    are left for the GUI thread, see `load_mayavi`, as is creating the
+    render context, see `init_render_context`, once the thread has
+    finished. An import error is left for the first plot to raise.
+
+    Returns:
+        threading.Thread: the started daemon thread
+    """
+
+    def run() -> None:
+        try:
+            load_vtk()
+        except Exception:
+            pass
+
+    thread = threading.Thread(target=run, name="prewarm", daemon=True)
+    thread.start()
+    return thread
+
+
+def init_render_context() -> None:
+    """Import Mayavi, start its engine and load the OpenGL driver, on the GUI thread
+
+    Renders once into a 1x1 offscreen window, which works without a
+    display server where VTK supports it, so the first scene does not pay
+    for the driver start-up. Opens no window.
+    """
+    with stage("init_render_context"):
+        load_mayavi()
+        mlab.get_engine()
+        window = tvtk.RenderWindow(off_screen_rendering=True, size=(1, 1))
+        window.add_renderer(tvtk.Renderer())
+        window.render()
+        window.finalize()
 
 
 class MagneticField(object):
-    def __init__(self, radius: float = 0.1, current: float = 1.0, spacing=50j) -> None:
+    # Shared by all instances, the GUI creates a new one for every plot
+    canonical_fields = CanonicalFields()
+
+    def __init__(
+        self,
+        radius: float = 0.1,
+        current: float = 1.0,
+        spacing=50j,
+        engine: str = "direct",
+        tol: float = 1e-3,
+        configuration: str = "pair",
+        dtype=np.float64,
+        memory_limit: Optional[float] = None,
+        workers: Optional[int] = 1,
+        elliptic: str = "scipy",
+        cache: Optional[FieldCache] = None,
+        symmetry: bool = True,
+        profiler: Optional[Profiler] = None,
+        progressive: bool = False,
+        coarse_spacing=25j,
+        wire_cutoff: float = 0.0,
+    ) -> None:
+        self.sp = spacing  # grid spacing (complex number = inclusive bounds
+        # "direct" evaluates the elliptic integrals at every grid point,
+        # "table" evaluates them on a 2D (rho, z) table and interpolates
+        self.engine = engine
+        self.tol = tol  # relative error tolerance of the "table" engine
+        self.configuration = configuration  # key of `CONFIGURATIONS`
+        self.dtype = dtype  # float32 halves the memory of the field
+        self.memory_limit = memory_limit  # bytes of scratch memory per slab
+        self.workers = workers  # threads computing slabs, None for all cores
+        self.elliptic = elliptic  # "scipy" or "agm" elliptic integrals
+        self.cache = cache  # on-disk cache of previously computed fields
+        self.symmetry = symmetry  # only evaluate the fundamental region
+        # Show a coarse grid first and refine it in the background
+        self.progressive = progressive
+        self.coarse_spacing = coarse_spacing  # points per axis of the first level
+        self.wire_cutoff = wire_cutoff  # wire thickness as a fraction of the radius
+        self._refinement = None  # cancels the running refinement
+        # Per-stage timings of every plot, see `Profiler.last`
+        self.profiler = profiler if profiler is not None else Profiler()
+        # Persistent scene of `update_scene`
+        self.figure = None
+        self.objs = None
+        self.coil_tubes = []
+        self.seedtype = None
+        self.set_coils(radius, current)
+
+    def set_coils(self, radius: float, current: float) -> None:
         self.radius = radius
         self.current = current
         self.Lx = self.radius * 4
         self.Ly = self.radius * 4
         self.Lz = self.radius * 4
-        self.sp = spacing  # grid spacing (complex number = inclusive bounds
+        self.grid = Grid(self.Lx, self.Ly, self.Lz, self.sp)
+
+    def levels(self) -> List[Grid]:
+        """Grids of progressive rendering, coarsest first
+
+        The number of points per axis doubles from `coarse_spacing` up to
+        the final grid, a real (step) spacing has no coarser levels.
+        """
+        n = self.grid.shape[0]
+        if complex(self.sp).imag == 0:
+            return [self.grid]
+        sizes = []
+        size = int(complex(self.coarse_spacing).imag)
+        while size < n:
+            sizes.append(size)
+            size *= 2
+        return [Grid(self.Lx, self.Ly, self.Lz, s * 1j) for s in sizes] + [self.grid]
+
+    def grid_of(self, B: np.ndarray) -> Grid:
+        """Grid of a field of this instance, the final grid or a level"""
+        if B.shape[1:] == self.grid.shape:
+            return self.grid
+        return Grid(self.Lx, self.Ly, self.Lz, B.shape[1] * 1j)
+
+    def get_coils(self) -> List[Coil]:
+        """Coils of the configuration for the current radius and current"""
+        return CONFIGURATIONS[self.configuration](self.radius, self.current)
+
+    def field_at(self, points: np.ndarray) -> np.ndarray:
+        """Magnetic field at arbitrary (N, 3) points, e.g. sensor locations
+
+        Returns:
+            np.ndarray: B with shape (N, 3)
+        """
+        return field_at_points(
+            self.get_coils(),
+            points,
+            dtype=self.dtype,
+            elliptic=self.elliptic,
+            wire_cutoff=self.wire_cutoff,
+        )
+
+    def iter_field_at(self, chunks: Iterable[np.ndarray]) -> Iterator[np.ndarray]:
+        """Stream the field for an iterable of (n_i, 3) point chunks
+
+        Yields:
+            np.ndarray: B with shape (n_i, 3) for every chunk
+        """
+        return iter_field_at_points(
+            self.get_coils(),
+            chunks,
+            dtype=self.dtype,
+            elliptic=self.elliptic,
+            wire_cutoff=self.wire_cutoff,
+        )
 
-    def sphere_el(self, radius: float, current: float) -> None:
+    def sphere_el(
+        self, radius: float, current: float, B: Optional[np.ndarray] = None
+    ) -> None:
 
-        B = self.compute_all_coils(radius, current)
+        with self.profiler.run("sphere_el", radius=radius, current=current):
+            B = self.compute_all_coils(radius, current, B)
 
-        objs = self.scene_setup(B[0], B[1], B[2], seedtype="sphere")
-        # objs["streamlines"].seed.widget.phi_resolution = 10
-        # objs["streamlines"].seed.widget.theta_resolution = 10
-        objs["streamlines"].seed.widget.radius = radius
+            objs = self.scene_setup(B, seedtype="sphere")
+            MagneticField.configure_seed(objs, "sphere", radius)
 
+        self.refine(objs, radius, current, B)
         MagneticField.scene_style(objs)
 
-    def plane_el(self, radius: float, current: float) -> None:
+    def plane_el(
+        self, radius: float, current: float, B: Optional[np.ndarray] = None
+    ) -> None:
 
-        B = self.compute_all_coils(radius, current)
+        with self.profiler.run("plane_el", radius=radius, current=current):
+            B = self.compute_all_coils(radius, current, B)
 
-        objs = self.scene_setup(B[0], B[1], B[2], seedtype="plane")
-        objs["streamlines"].stream_tracer.maximum_propagation = 40.0
-        objs["streamlines"].seed.widget.resolution = 20
-        objs["streamlines"].seed.widget.handle_size = 0.5
-        objs["streamlines"].seed.widget.representation = "outline"
+            objs = self.scene_setup(B, seedtype="plane")
+            MagneticField.configure_seed(objs, "plane", radius)
 
+        self.refine(objs, radius, current, B)
         MagneticField.scene_style(objs)
 
-    def line_el(self, radius: float, current: float) -> None:
+    def line_el(
+        self, radius: float, current: float, B: Optional[np.ndarray] = None
+    ) -> None:
 
-        B = self.compute_all_coils(radius, current)
+        with self.profiler.run("line_el", radius=radius, current=current):
+            B = self.compute_all_coils(radius, current, B)
 
-        objs = self.scene_setup(B[0], B[1], B[2], seedtype="line")
-        objs["streamlines"].stream_tracer.maximum_propagation = 150
-        objs["streamlines"].seed.widget.resolution = 30
-        # objs["streamlines"].seed.widget.point1 = [95, 100.5, 100]  # placing seed
-        # objs["streamlines"].seed.widget.point2 = [105, 100.5, 100]
+            objs = self.scene_setup(B, seedtype="line")
+            MagneticField.configure_seed(objs, "line", radius)
 
+        self.refine(objs, radius, current, B)
         MagneticField.scene_style(objs)
 
-    def compute_all_coils(self, radius: float, current: float) -> np.ndarray:
-        self.__init__(radius, current)
-        x, y, z = self.get_grid("sparse")
-        # Get the grid spacing. Normally defined as a complex number since
-        # mgrid and ogrid need that for the interval to be inclusive on the upper
-        # bound.
-        sp = self.sp
-        if int(sp.imag) != 0:
-            sp = int(sp.imag)
-        else:
-            sp = int(sp.real)
+    @staticmethod
+    def configure_seed(objs: dict, seedtype: str, radius: float) -> None:
+        """Seed widget and tracer settings of each seed type"""
+        streamlines = objs["streamlines"]
+        if seedtype == "sphere":
+            # streamlines.seed.widget.phi_resolution = 10
+            # streamlines.seed.widget.theta_resolution = 10
+            # Default of `scene_pipeline`, reset when switching seed types
+            streamlines.stream_tracer.maximum_propagation = 100
+            streamlines.seed.widget.radius = radius
+        elif seedtype == "plane":
+            streamlines.stream_tracer.maximum_propagation = 40.0
+            streamlines.seed.widget.resolution = 20
+            streamlines.seed.widget.handle_size = 0.5
+            streamlines.seed.widget.representation = "outline"
+        elif seedtype == "line":
+            streamlines.stream_tracer.maximum_propagation = 150
+            streamlines.seed.widget.resolution = 30
+            # streamlines.seed.widget.point1 = [95, 100.5, 100]  # placing seed
+            # streamlines.seed.widget.point2 = [105, 100.5, 100]
+
+    def update_scene(
+        self,
+        radius: float,
+        current: float,
+        seedtype: str = "sphere",
+        B: Optional[np.ndarray] = None,
+    ) -> dict:
+        """Show the field in a persistent scene, updated in place
 
-        h = radius / 2.0
-        fig = mlab.figure(1, size=(800, 600), bgcolor=(1, 1, 1), fgcolor=(0, 0, 0))
+        The first call builds the scene like `sphere_el` and friends, but
+        returns instead of blocking in `mlab.show`, so it needs a running
+        GUI event loop or periodic calls to `process_events`. Later calls
+        swap the dataset of the field source and move the coil tubes, VTK
+        then only re-executes the filters downstream of what changed, and a
+        different `seedtype` only swaps the seed widget of the streamlines.
+        The scene is rebuilt if its window has been closed.
 
-        B = np.zeros((3, sp, sp, sp))
-        # TODO: add to a loop
-        B += MagneticField.magnetic_field_single_coil(
-            x,
-            y,
-            z,
-            radius,
-            current,
-            centre=[0, 0, +h],
-        )
-        B += MagneticField.magnetic_field_single_coil(
-            x,
-            y,
-            z,
-            radius,
-            current,
-            centre=[0, 0, -h],
-        )
-        MagneticField.draw_coil(
-            radius,
-            name="Coil 1",
-            color=(0, 0, 1),
-            centre=[0, 0, +h],
-        )
-        MagneticField.draw_coil(
-            radius,
-            name="Coil 2",
-            color=(0, 1, 1),
-            centre=[0, 0, -h],
+        Args:
+            radius (float): radius of the coils
+            current (float): current through the coils
+            seedtype (str, optional): "sphere", "plane" or "line".
+                Defaults to "sphere".
+            B (np.ndarray, optional): precomputed field, see `compute_field`.
+                Defaults to None.
+
+        Returns:
+            dict: the pipeline objects of `scene_pipeline`
+        """
+        with self.profiler.run(
+            "update_scene", radius=radius, current=current, seedtype=seedtype
+        ):
+            if B is None:
+                B = self.compute_field(radius, current)
+            else:
+                self.set_coils(radius, current)
+            coils = self.get_coils()
+
+            if self.figure is None or self.figure not in mlab.get_engine().scenes:
+                with stage("draw_coils"):
+                    self.coil_tubes = self.draw_coils(coils)
+                self.figure = mlab.gcf()
+                self.objs = self.scene_setup(B, seedtype)
+                MagneticField.configure_seed(self.objs, seedtype, radius)
+                MagneticField.style(self.objs)
+                self.seedtype = seedtype
+                return self.objs
+
+            with stage("update_coils"):
+                self.update_coils(coils)
+            with stage("image_data") as st:
+                st.array("B", B)
+                # Assigning a new dataset keeps every filter and module
+                self.objs["field"].data = self.image_data(B)
+            with stage("update_seed"):
+                streamlines = self.objs["streamlines"]
+                if seedtype != self.seedtype:
+                    # Swapped as mlab's streamline factory does, `seedtype` is
+                    # not a trait of the Streamline module
+                    seed = streamlines.seed
+                    seed.widget = seed.widget_list[_SEED_WIDGETS[seedtype]]
+                    self.seedtype = seedtype
+                # Fit the seed to the new grid before applying its settings
+                streamlines.seed.widget.place_widget(
+                    -self.Lx, self.Lx, -self.Ly, self.Ly, -self.Lz, self.Lz
+                )
+                MagneticField.configure_seed(self.objs, seedtype, radius)
+                streamlines.seed.update_poly_data()
+
+        return self.objs
+
+    def update_coils(self, coils: List[Coil]) -> None:
+        """Move the coil tubes of the persistent scene to `coils`"""
+        if len(coils) != len(self.coil_tubes):
+            for tube in self.coil_tubes:
+                tube.remove()
+            self.coil_tubes = self.draw_coils(coils)
+            return
+        for tube, coil in zip(self.coil_tubes, coils):
+            x, y, z = MagneticField.coil_points(
+                coil.radius, coil.centre, axis=coil.axis
+            )
+            tube.mlab_source.trait_set(x=x, y=y, z=z)
+            # Surface <- module manager <- tube filter
+            tube.parent.parent.filter.radius = coil.radius * 0.1
+
+    @staticmethod
+    def process_events() -> None:
+        """Handle pending events of the Mayavi windows
+
+        Lets another event loop, e.g. Tk's, drive the scene of
+        `update_scene` instead of blocking in `mlab.show`. Does nothing
+        until Mayavi has been imported, there cannot be a window before.
+        """
+        if mayavi_loaded():
+            GUI.process_events()
+
+    def animate(
+        self,
+        radius: float,
+        waveforms: Optional[Sequence[Waveform]] = None,
+        output: str = "frames",
+        fps: float = 25.0,
+        duration: Optional[float] = None,
+        seedtype: str = "sphere",
+        size: Tuple[int, int] = (800, 600),
+        video: Optional[str] = None,
+    ) -> List[str]:
+        """Render the field of AC coil currents offscreen to PNG frames
+
+        The unit field of every coil is computed once, each frame is then a
+        linear combination of them written into the array VTK reads from,
+        see `UnitFields`, followed by a render of the same pipeline. Blocks
+        until every frame is written, an event loop can instead compute
+        `unit_fields` on a worker thread and step through `render_frames`.
+
+        Args:
+            radius (float): radius of the coils
+            waveforms (Sequence[Waveform], optional): current of every coil.
+                Defaults to the coil currents of the configuration at 1 Hz.
+            output (str, optional): directory of the frames.
+                Defaults to "frames".
+            fps (float, optional): frames per second. Defaults to 25.0.
+            duration (float, optional): seconds, see `frame_times`.
+                Defaults to the common period of the waveforms.
+            seedtype (str, optional): "sphere", "plane" or "line".
+                Defaults to "sphere".
+            size (Tuple[int, int], optional): frame size in pixels.
+                Defaults to (800, 600).
+            video (str, optional): also encode the frames into this video
+                file with ffmpeg, e.g. "field.mp4". Defaults to None.
+
+        Returns:
+            List[str]: paths of the frames
+        """
+        with self.profiler.run("animate", radius=radius):
+            unit = self.unit_fields(radius)
+            paths = list(
+                self.render_frames(
+                    unit, waveforms, output, fps, duration, seedtype, size
+                )
+            )
+
+        if video is not None:
+            MagneticField.encode_video(output, video, fps)
+        return paths
+
+    def unit_fields(
+        self,
+        radius: float,
+        progress: Optional[Callable[[int, int], None]] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> UnitFields:
+        """Unit fields of the coils for `render_frames`
+
+        Does not touch Mayavi, so it can run on a worker thread.
+
+        Args:
+            radius (float): radius of the coils
+            progress (Callable[[int, int], None], optional): called with the
+                finished and total slabs, see `UnitFields`. Defaults to None.
+            cancel (threading.Event, optional): set to stop the computation
+                with `ComputationCancelled`. Defaults to None.
+        """
+        self.set_coils(radius, self.current)
+        with stage("unit_fields"):
+            return UnitFields(
+                self.get_coils(),
+                self.grid,
+                dtype=self.dtype,
+                elliptic=self.elliptic,
+                workers=self.workers,
+                progress=progress,
+                cancel=cancel,
+                wire_cutoff=self.wire_cutoff,
+            )
+
+    def render_frames(
+        self,
+        unit: UnitFields,
+        waveforms: Optional[Sequence[Waveform]] = None,
+        output: str = "frames",
+        fps: float = 25.0,
+        duration: Optional[float] = None,
+        seedtype: str = "sphere",
+        size: Tuple[int, int] = (800, 600),
+    ) -> Iterator[str]:
+        """Render the frames of `animate` offscreen, one per iteration
+
+        Every frame is only rendered when the next path is requested, so an
+        event loop can render one frame per step and stay responsive.
+        Closing the generator early closes the figure. Arguments as for
+        `animate`, with the unit fields from `unit_fields`.
+
+        Yields:
+            str: path of the frame just written
+        """
+        coils = unit.coils
+        if waveforms is None:
+            waveforms = [Waveform(c.current, 1.0) for c in coils]
+        times = frame_times(waveforms, fps, duration)
+        os.makedirs(output, exist_ok=True)
+
+        offscreen = mlab.options.offscreen
+        mlab.options.offscreen = True
+        fig = None
+        try:
+            B = unit.frame(waveforms, times[0])
+
+            with stage("draw_coils"):
+                fig = mlab.figure("AC animation", size=size)
+                self.draw_coils(coils, figure=fig, size=size)
+            objs = self.scene_setup(B, seedtype)
+            MagneticField.configure_seed(objs, seedtype, self.radius)
+            MagneticField.style(objs)
+            # Fixed colours, otherwise every frame is scaled to its own range
+            lut = objs["streamlines"].module_manager.scalar_lut_manager
+            lut.use_default_range = False
+            lut.data_range = (0.0, unit.peak(waveforms))
+
+            image = objs["field"].data
+            for k, t in enumerate(times):
+                with stage("frame"):
+                    unit.frame(waveforms, t, out=B)
+                    # B is shared with VTK, flag the in-place change
+                    image.point_data.vectors.modified()
+                    objs["field"].update()
+                with stage("render"):
+                    path = os.path.join(output, f"frame_{k:05d}.png")
+                    mlab.savefig(path, size=size, figure=fig)
+                yield path
+        finally:
+            if fig is not None:
+                mlab.close(fig)
+            mlab.options.offscreen = offscreen
+
+    @staticmethod
+    def encode_video(frames: str, video: str, fps: float) -> None:
+        """Encode the frames written by `animate` with ffmpeg"""
+        if shutil.which("ffmpeg") is None:
+            raise RuntimeError("Encoding a video requires ffmpeg on the PATH")
+        subprocess.run(
+            [
+                "ffmpeg",
+                "-y",
+                "-loglevel",
+                "error",
+                "-framerate",
+                str(fps),
+                "-i",
+                os.path.join(frames, "frame_%05d.png"),
+                "-pix_fmt",
+                "yuv420p",
+                video,
+            ],
+            check=True,
         )
-        del x, y, z
+
+    def compute_all_coils(
+        self, radius: float, current: float, B: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Draw the coils and compute their field, unless `B` is given"""
+        self.cancel_refinement()
+        self.set_coils(radius, current)
+        coils = CONFIGURATIONS[self.configuration](radius, current)
+
+        with stage("draw_coils"):
+            self.draw_coils(coils)
+
+        if B is None:
+            level = 0 if self.progressive else None
+            B = self.compute_field(radius, current, level=level)
+        return B
+
+    def refine(self, objs: dict, radius: float, current: float, B: np.ndarray) -> None:
+        """Compute the levels finer than `B` in the background
+
+        Every finished level is swapped into the scene of `objs` on the GUI
+        thread, see `swap_field`. A new refinement cancels the previous one.
+        Does nothing if `B` is on the final grid already.
+        """
+        self.cancel_refinement()
+        levels = [
+            i for i, grid in enumerate(self.levels()) if grid.shape[0] > B.shape[1]
+        ]
+        if not levels:
+            return
+        cancel = self._refinement = threading.Event()
+
+        def run() -> None:
+            for level in levels:
+                if cancel.is_set():
+                    return
+                try:
+                    B = self.compute_field(radius, current, cancel=cancel, level=level)
+                except ComputationCancelled:
+                    return
+                # VTK may only be touched from the GUI thread
+                GUI.invoke_later(self.swap_field, objs, B, cancel)
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def cancel_refinement(self) -> None:
+        """Stop the background refinement of the previous plot, if any"""
+        if self._refinement is not None:
+            self._refinement.set()
+            self._refinement = None
+
+    def swap_field(
+        self, objs: dict, B: np.ndarray, cancel: Optional[threading.Event] = None
+    ) -> None:
+        """Replace the field of a live scene, keeping its filters and modules
+
+        Args:
+            objs (dict): pipeline objects of `scene_pipeline`
+            B (np.ndarray): field on the final grid or a level of it
+            cancel (threading.Event, optional): skip the swap if set, e.g.
+                when a newer plot replaced the scene. Defaults to None.
+        """
+        if cancel is not None and cancel.is_set():
+            return
+        with self.profiler.run("swap_field", points=int(np.prod(B.shape[1:]))):
+            with stage("image_data") as st:
+                st.array("B", B)
+                objs["field"].data = self.image_data(B)
+
+    def compute_field(
+        self,
+        radius: float,
+        current: float,
+        progress: Optional[Callable[[int, int], None]] = None,
+        cancel: Optional[threading.Event] = None,
+        level: Optional[int] = None,
+    ) -> np.ndarray:
+        """Field of the coils on the grid, without drawing anything
+
+        Does not touch Mayavi, so it can run on a worker thread while the
+        GUI stays responsive, the result is then passed to e.g. `sphere_el`.
+
+        Args:
+            radius (float): radius of the coils
+            current (float): current through the coils
+            progress (Callable[[int, int], None], optional): called with the
+                finished and total slabs, see `field_compute.compute_field`.
+                Defaults to None.
+            cancel (threading.Event, optional): set to stop the computation
+                with `ComputationCancelled`. Defaults to None.
+            level (int, optional): index of the progressive level to compute
+                on, see `levels`. Defaults to the final grid.
+
+        Returns:
+            np.ndarray: B with shape (3, nx, ny, nz)
+        """
+        self.set_coils(radius, current)
+        coils = CONFIGURATIONS[self.configuration](radius, current)
+        grid = self.grid if level is None else self.levels()[level]
+
+        # Both stores keep fields in canonical form, so changing only the
+        # radius or current rescales a stored field instead of recomputing it
+        if self.cache is None:
+            compute = MagneticField.canonical_fields.compute
+        else:
+            compute = self.cache.compute
+        with stage("field") as st:
+            # Rescaled straight into the memory layout VTK uses
+            B = compute(
+                coils,
+                grid,
+                engine=self.engine,
+                tol=self.tol,
+                dtype=self.dtype,
+                memory_limit=self.memory_limit,
+                workers=self.workers,
+                elliptic=self.elliptic,
+                symmetry=self.symmetry,
+                out=point_order_field(grid.shape, self.dtype),
+                progress=progress,
+                cancel=cancel,
+                wire_cutoff=self.wire_cutoff,
+            )
+            st.array("B", B)
 
         return B
 
+    def export_field(
+        self,
+        path: str,
+        radius: Optional[float] = None,
+        current: Optional[float] = None,
+        magnitude: bool = False,
+        progress: Optional[Callable[[int, int], None]] = None,
+        cancel: Optional[threading.Event] = None,
+    ) -> str:
+        """Stream the field on the final grid to a `.vti` or `.npy` file
+
+        The field is computed slab by slab and never held in memory as a
+        whole, see `field_export.export_field`. Does not touch Mayavi.
+
+        Args:
+            path (str): output file, ".vti" for ParaView or ".npy"
+            radius (float, optional): radius of the coils. Defaults to the
+                radius of the last plot.
+            current (float, optional): current through the coils. Defaults
+                to the current of the last plot.
+            magnitude (bool, optional): also store |B|. Defaults to False.
+            progress (Callable[[int, int], None], optional): called with the
+                written and total z planes. Defaults to None.
+            cancel (threading.Event, optional): set to stop the export with
+                `ComputationCancelled`. Defaults to None.
+
+        Returns:
+            str: `path`
+        """
+        radius = self.radius if radius is None else radius
+        current = self.current if current is None else current
+        self.set_coils(radius, current)
+        with self.profiler.run("export_field", radius=radius, current=current):
+            return export_field(
+                self.get_coils(),
+                self.grid,
+                path,
+                engine=self.engine,
+                tol=self.tol,
+                dtype=self.dtype,
+                memory_limit=self.memory_limit or EXPORT_MEMORY_LIMIT,
+                workers=self.workers,
+                elliptic=self.elliptic,
+                magnitude=magnitude,
+                progress=progress,
+                cancel=cancel,
+                wire_cutoff=self.wire_cutoff,
+            )
+
+    def adaptive_el(
+        self, radius: float, current: float, seedtype: str = "sphere", **kwargs
+    ) -> None:
+        """Plot the field on an `AdaptiveGrid` refined near the windings
+
+        Extra keyword arguments are passed to `AdaptiveGrid`.
+        """
+        with self.profiler.run("adaptive_el", radius=radius, current=current):
+            self.set_coils(radius, current)
+            coils = CONFIGURATIONS[self.configuration](radius, current)
+            with stage("draw_coils"):
+                self.draw_coils(coils)
+
+            with stage("field"):
+                grid = AdaptiveGrid(
+                    coils,
+                    (self.Lx, self.Ly, self.Lz),
+                    dtype=self.dtype,
+                    elliptic=self.elliptic,
+                    wire_cutoff=self.wire_cutoff,
+                    **kwargs,
+                ).build()
+            with stage("unstructured_grid") as st:
+                points, cells, B = grid.to_unstructured()
+                ug = tvtk.UnstructuredGrid(points=points)
+                ug.set_cells(tvtk.Hexahedron().cell_type, cells)
+                ug.point_data.vectors = B
+                ug.point_data.vectors.name = "B"
+                field = mlab.pipeline.add_dataset(ug, name="B field")
+                st.array("points", points)
+                st.array("cells", cells)
+
+            objs = self.scene_pipeline(field, seedtype)
+            if seedtype == "sphere":
+                objs["streamlines"].seed.widget.radius = radius
+
+        MagneticField.scene_style(objs)
+
+    def traced_el(
+        self, radius: float, current: float, seedtype: str = "sphere", **kwargs
+    ) -> None:
+        """Plot field lines traced on the analytic field, without a grid
+
+        Extra keyword arguments are passed to `trace_field_lines`.
+        """
+        with self.profiler.run("traced_el", radius=radius, current=current):
+            self.set_coils(radius, current)
+            coils = CONFIGURATIONS[self.configuration](radius, current)
+            with stage("draw_coils"):
+                self.draw_coils(coils)
+
+            resolution = {"sphere": 10, "plane": 20, "line": 30}[seedtype]
+            seeds = seed_points(seedtype, size=radius, resolution=resolution)
+            kwargs.setdefault("max_length", 10 * radius)
+            with stage("trace"):
+                lines, norms = trace_field_lines(
+                    coils,
+                    seeds,
+                    bounds=(self.Lx, self.Ly, self.Lz),
+                    elliptic=self.elliptic,
+                    wire_cutoff=self.wire_cutoff,
+                    **kwargs,
+                )
+
+            # All polylines in a single dataset, see the Mayavi "plotting many
+            # lines" example
+            with stage("lines") as st:
+                points = np.concatenate(lines)
+                start = np.cumsum([0] + [len(l) for l in lines[:-1]])
+                connections = np.concatenate(
+                    [
+                        np.stack(
+                            [s + np.arange(len(l) - 1), s + np.arange(1, len(l))], -1
+                        )
+                        for s, l in zip(start, lines)
+                    ]
+                )
+                src = mlab.pipeline.scalar_scatter(
+                    points[:, 0], points[:, 1], points[:, 2], np.concatenate(norms)
+                )
+                src.mlab_source.dataset.lines = connections
+                src.update()
+                streamlines = mlab.pipeline.surface(
+                    mlab.pipeline.stripper(src),
+                    colormap="jet",
+                    line_width=1,
+                    opacity=0.6,
+                )
+                st.array("points", points)
+
+        MagneticField.scene_style({"field": src, "streamlines": streamlines})
+
+    @staticmethod
+    def draw_coils(coils: list, figure=1, size=(800, 600)) -> list:
+        fig = mlab.figure(figure, size=size, bgcolor=(1, 1, 1), fgcolor=(0, 0, 0))
+        colors = [(0, 0, 1), (0, 1, 1)]
+        return [
+            MagneticField.draw_coil(
+                coil.radius,
+                name=f"Coil {i + 1}",
+                color=colors[i % len(colors)],
+                centre=coil.centre,
+                axis=coil.axis,
+            )
+            for i, coil in enumerate(coils)
+        ]
+
     @staticmethod
     def draw_coil(
         radius: float,
@@ -106,12 +863,9 @@ class MagneticField(object):
         color=(0, 0, 1),
         centre: np.array = np.array([0, 0, 0]),
         scale: np.array = np.array([1, 1, 1]),
+        axis: np.array = np.array([0, 0, 1]),
     ):
-        l = 40
-        theta = np.linspace(0, 2 * np.pi, l)
-        y = ((radius * np.sin(theta)) + centre[0]) * scale[0]
-        x = ((radius * np.cos(theta)) + centre[1]) * scale[1]
-        z = (np.zeros(l) + centre[2]) * scale[2]
+        x, y, z = MagneticField.coil_points(radius, centre, scale, axis)
         return mlab.plot3d(
             x,
             y,
@@ -122,125 +876,86 @@ class MagneticField(object):
         )
 
     @staticmethod
-    def magnetic_field_single_coil(
-        x: np.ndarray,
-        y: np.ndarray,
-        z: np.ndarray,
+    def coil_points(
         radius: float,
-        current: float,
-        centre: np.array = np.array([0.0, 0.0, 0.0]),
-        scale: np.array = np.array([1.0, 1.0, 1.0]),
-        normalise: bool = False,
+        centre: np.array = np.array([0, 0, 0]),
+        scale: np.array = np.array([1, 1, 1]),
+        axis: np.array = np.array([0, 0, 1]),
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-        """
-        Calculate the magnetic field of a single coil loop
+        """Points along a coil loop, see `draw_coil`"""
+        l = 40
+        theta = np.linspace(0, 2 * np.pi, l)
+        # Two unit vectors spanning the plane of the coil
+        axis = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+        u = np.cross(axis, [1, 0, 0] if abs(axis[0]) < 0.9 else [0, 1, 0])
+        u /= np.linalg.norm(u)
+        v = np.cross(axis, u)
+        x, y, z = (
+            (radius * (np.cos(theta) * u[k] + np.sin(theta) * v[k]) + centre[k])
+            * scale[k]
+            for k in range(3)
+        )
+        return x, y, z
 
-        The equations in Cylindrical coordinates are given by:
-        .. math::
-        B_z = \frac{\mu_0I}{2\pi}\frac{1}{[(R + \rho)^2 + z^2]^{1/2}} \times
-            \left[K(k^2)+\frac{R^2 - \rho^2 - z^2}{(R-\rho)^2 + z^2}E(k^2)\right]
-        B_\rho = \frac{\mu_0I}{2\pi\rho} \frac{z}{[R+\rho)^2 +z^2]^{1/2}} \times
-            \left[-K(k^2) + E(k^2)\frac{R^2+\rho^2+z^2}{(R-\rho)^2+z^2}\right]
+    def scene_setup(self, B: np.ndarray, seedtype: str) -> dict:
+        """Field source on the uniform grid followed by `scene_pipeline`
 
-        where K and E are the elliptic integrals
+        The grid is described to VTK by its origin and spacing only. B is
+        handed over without a copy when it is laid out in point order, see
+        `point_order_field`, and copied into that layout otherwise.
 
         Args:
-            x (np.ndarray): generated by `np.mgrid`
-            y (np.ndarray): generated by `np.mgrid`
-            z (np.ndarray): generated by `np.mgrid`
-            radius (float): radius of the coil
-            current (float): current through the coil
-            normalise (bool, optional): normalise field. Defaults to False.
-
-        Returns:
-            Tuple[np.ndarray, np.ndarray, np.ndarray]: Magnetic field in Cartesian coordinates
+            B (np.ndarray): field with shape (3, nx, ny, nz)
+            seedtype (str): "sphere", "plane" or "line"
         """
-
-        R = radius
-        I = current
-        if abs(radius) < 1e-10:
-            R = 1e-10
-        if abs(current) < 1e-10:
-            I = 1e-10
-
-        x = (x - centre[0]) * scale[0]
-        y = (y - centre[1]) * scale[1]
-        z = (z - centre[2]) * scale[2]
-
-        rho = np.sqrt(x ** 2 + y ** 2)
-
-        mu = 4 * np.pi * 10.0 ** (-7)  # μ0 constant
-        Bz_norm_factor = 1
-        Brho_norm_factor = 1
-        if normalise:
-            Bz_norm_factor = mu / (2 * np.pi)
-            Brho_norm_factor = Bz_norm_factor / rho
-
-        # Special ellipse E and K
-        E = special.ellipe((4 * R * rho) / ((R + rho) ** 2 + z ** 2))
-        K = special.ellipk((4 * R * rho) / ((R + rho) ** 2 + z ** 2))
-        Bz = (
-            I
-            * Bz_norm_factor
-            / (np.sqrt((R + rho) ** 2 + z ** 2))
-            * (K + (R ** 2 - rho ** 2 - z ** 2) / ((R - rho) ** 2 + z ** 2) * E)
-        )
-        Brho = (
-            I
-            * Brho_norm_factor
-            * z
-            / (rho * np.sqrt((R + rho) ** 2 + z ** 2))
-            * (-K + (R ** 2 + rho ** 2 + z ** 2) / ((R - rho) ** 2 + z ** 2) * E)
-        )
-
-        # At origin we get division by zero which yields NaN, physically the
-        # field is zero in that location
-        Brho[np.isnan(Brho)] = 0
-        Brho[np.isinf(Brho)] = 0
-        Bz[np.isnan(Bz)] = 0
-        Bz[np.isinf(Bz)] = 0
-
-        Bx, By = (x / rho) * Brho, (y / rho) * Brho
-        B = np.array([Bx, By, Bz])
-        del Brho, E, K
-
-        return B
-
-    def scene_setup(
-        self,
-        Bx: np.ndarray,
-        By: np.ndarray,
-        Bz: np.ndarray,
-        seedtype: str,
-    ) -> dict:
-
-        # vector_field does not take sparse grids (as far as I know) so we have
-        # to generate a dense xyz grid to get the vector field coordinates right
-        x, y, z = self.get_grid("dense")
-        Bnorm = np.sqrt(Bx ** 2 + By ** 2 + Bz ** 2)
-        field = mlab.pipeline.vector_field(x, y, z, Bx, By, Bz, name="B field")
-        del x, y, z
-        magnitude = mlab.pipeline.extract_vector_norm(field)
-        contours: IsoSurface = mlab.pipeline.iso_surface(
-            magnitude,
-            contours=4,
-            transparent=True,
-            opacity=0.6,
-            colormap="YlGnBu",
-            # vmin=0,
-            # vmax=0.5,
-        )
-
-        streamlines: Streamline = mlab.pipeline.streamline(
-            magnitude,
-            seedtype=seedtype,
-            integration_direction="both",
-            transparent=True,
-            opacity=0.2,
-            colormap="jet",
-            # vmin=0,
-            # vmax=0.5,
+        with stage("image_data") as st:
+            st.array("B", B)
+            image = self.image_data(B)
+            field = mlab.pipeline.add_dataset(image, name="B field")
+
+        return self.scene_pipeline(field, seedtype)
+
+    def image_data(self, B: np.ndarray) -> "tvtk.ImageData":
+        """`tvtk.ImageData` of the grid of B with B as its point vectors"""
+        if not B.T.flags.c_contiguous:
+            vectors = point_order_field(B.shape[1:], B.dtype)
+            np.copyto(vectors, B)
+            B = vectors
+        grid = self.grid_of(B)
+        image = tvtk.ImageData(
+            origin=grid.origin, spacing=grid.step, dimensions=grid.shape
         )
+        # A C-contiguous array of a VTK type is wrapped, not copied
+        image.point_data.vectors = B.T.reshape(-1, 3)
+        image.point_data.vectors.name = "B"
+        return image
+
+    def scene_pipeline(self, field, seedtype: str) -> dict:
+        """Iso-surfaces and streamlines of |B| for any Mayavi field source"""
+        with stage("extract_vector_norm"):
+            magnitude = mlab.pipeline.extract_vector_norm(field)
+        with stage("iso_surface"):
+            contours: "IsoSurface" = mlab.pipeline.iso_surface(
+                magnitude,
+                contours=4,
+                transparent=True,
+                opacity=0.6,
+                colormap="YlGnBu",
+                # vmin=0,
+                # vmax=0.5,
+            )
+
+        with stage("streamline"):
+            streamlines: "Streamline" = mlab.pipeline.streamline(
+                magnitude,
+                seedtype=seedtype,
+                integration_direction="both",
+                transparent=True,
+                opacity=0.2,
+                colormap="jet",
+                # vmin=0,
+                # vmax=0.5,
+            )
 
         contours.actor.property.frontface_culling = True
         contours.normals.filter.feature_angle = 90
@@ -257,8 +972,13 @@ class MagneticField(object):
         return pipeline_obj
 
     @staticmethod
-    @mlab.show
     def scene_style(objs: dict, **kwargs) -> None:
+        # mlab.show as a decorator would import Mayavi with this module
+        mlab.show(MagneticField.style)(objs)
+
+    @staticmethod
+    def style(objs: dict) -> None:
+        """Colour bar, axes and camera of a scene, without showing it"""
         sc = mlab.scalarbar(
             objs["streamlines"],
             title="Field\nStrength [T]",
@@ -279,31 +999,8 @@ class MagneticField(object):
     def get_grid(
         self, mat_type: str = "sparse"
     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
-        """Return either a dense or a sparse 3D grid
-
-        Args:
-            mat_type (str, optional): dense or sparse. Defaults to "sparse".
-
-        Returns:
-            Tuple[np.ndarray, np.ndarray, np.ndarray]: x, y, z
-        """
-
-        if mat_type == "sparse":
-            x, y, z = np.ogrid[
-                -self.Lx : self.Lx : self.sp,
-                -self.Ly : self.Ly : self.sp,
-                -self.Lz : self.Lz : self.sp,
-            ]
-            return x, y, z
-        elif mat_type == "dense":
-            x, y, z = np.mgrid[
-                -self.Lx : self.Lx : self.sp,
-                -self.Ly : self.Ly : self.sp,
-                -self.Lz : self.Lz : self.sp,
-            ]
-            return x, y, z
-        else:
-            raise (f"Input grid format: {mat_type} not supported")
+        """Return either a dense or a sparse 3D grid, see `Grid.get_grid`"""
+        return self.grid.get_grid(mat_type)
 
 
 if __name__ == "__main__":
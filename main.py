@@ -1,5 +1,9 @@
+import math
+import queue
 import subprocess
+import threading
 import tkinter as tk
+from tkinter import filedialog
 from tkinter import messagebox as msg
 from tkinter import ttk
 import tkinter.font as tkFont
@@ -7,7 +11,11 @@ from PIL import ImageTk, Image
 
 # Externally sourced functionality for TkInter Widgets
 from tktooltip import ToolTip
-from magnetic_field import MagneticField
+from field_cache import FieldCache
+from field_compute import ComputationCancelled
+from instrumentation import Profiler
+from magnetic_field import MagneticField, init_render_context, mayavi_loaded, prewarm
+from waveforms import Waveform, frame_times
 
 # TODO: convert report to HTML
 
@@ -79,6 +87,30 @@ class Visualisation(Page):
         self.e_R = None
         self.e_I = None
         self.cb = None
+        self.b_plot = None
+        self.b_animate = None
+        self.b_cancel = None
+        self.progress = None
+        # The field is computed on a worker thread, which reports back to the
+        # Tk thread through this queue
+        self.events = queue.Queue()
+        self.cancel_event = None
+        # Fields computed in previous sessions are reused from disk
+        self.cache = FieldCache()
+        # Stage timings of every plot, shown in the status area
+        self.status_text = tk.StringVar(value="No plots yet")
+        self.plot_records = []  # runs of the current plot
+        self.profiler = Profiler(memory=True, on_run=self.show_timings)
+        # A single persistent scene, updated in place by every plot with a
+        # coarse grid first, then refined level by level
+        self.plot = MagneticField(
+            cache=self.cache, profiler=self.profiler, progressive=True
+        )
+        self.levels_shown = 0
+        self.plot_error = None  # scene update failure of the running plot
+        # VTK is imported in the background while the user is entering
+        # parameters, Mayavi while the first plot computes its field
+        self.prewarm = prewarm()
 
         self.dark_theme = False
         if self.tk.eval("return $theme") == "dark":
@@ -86,6 +118,9 @@ class Visualisation(Page):
 
         self.inputs(self.frame)
 
+        # Tk drives the Mayavi window instead of blocking in mlab.show
+        self.process_events()
+
     def inputs(self, frame):
         # Define child frame for the master
         input_frame = tk.Frame(frame)
@@ -102,10 +137,14 @@ class Visualisation(Page):
         # Add tooltips wideget
         self.tool_tips(input_frame)
 
+        # Timings of the last plot
+        self.status(input_frame)
+
         # Blank Lines
         input_frame.grid_rowconfigure(5, minsize=20)
         input_frame.grid_rowconfigure(7, minsize=10)
         input_frame.grid_rowconfigure(9, minsize=30)
+        input_frame.grid_rowconfigure(11, minsize=10)
 
     def buttons_and_entries(self, input_frame):
         # Validate that entries receive real numbers
@@ -126,10 +165,22 @@ class Visualisation(Page):
         self.cb.current(0)
         self.cb.grid(column=1, row=3, padx=5, pady=(0, 5), sticky="ew")
 
-        b_plot = ttk.Button(
+        self.b_plot = ttk.Button(
             input_frame, text="Plot", command=self.plot_field, style="Accent.TButton"
         )
-        b_plot.grid(column=0, row=6, sticky="ew")
+        self.b_plot.grid(column=0, row=6, sticky="ew")
+
+        self.progress = ttk.Progressbar(input_frame, mode="determinate", maximum=1)
+        self.progress.grid(column=1, row=6, padx=5, sticky="ew")
+
+        self.b_cancel = ttk.Button(
+            input_frame,
+            text="Cancel",
+            command=self.cancel_plot,
+            style="Toggle.TButton",
+            state="disabled",
+        )
+        self.b_cancel.grid(column=3, row=6)
 
         # Bottom row buttons
         ttk.Button(
@@ -140,6 +191,21 @@ class Visualisation(Page):
             style="Toggle.TButton",
         ).grid(column=0, row=10)
 
+        ttk.Button(
+            input_frame,
+            text="Save Timings",
+            command=self.save_timings,
+            style="Toggle.TButton",
+        ).grid(column=1, row=10)
+
+        self.b_animate = ttk.Button(
+            input_frame,
+            text="AC Animation",
+            command=self.animate,
+            style="Toggle.TButton",
+        )
+        self.b_animate.grid(column=2, row=10)
+
         ttk.Button(
             input_frame, text="Quit", command=self.quit, style="Toggle.TButton"
         ).grid(column=3, row=10)
@@ -190,6 +256,38 @@ class Visualisation(Page):
             # relief=tk.RIDGE,
         ).grid(column=0, row=3)
 
+    def status(self, input_frame):
+        status_frame = ttk.LabelFrame(input_frame, text="Last Plot Timings")
+        status_frame.grid(
+            column=0, row=12, ipadx=10, ipady=5, columnspan=4, sticky="ew"
+        )
+
+        ttk.Label(
+            status_frame,
+            textvariable=self.status_text,
+            justify="left",
+            font=("TkFixedFont", 8),
+        ).pack(anchor=tk.W)
+
+    def show_timings(self, record):
+        if threading.current_thread() is not threading.main_thread():
+            # Tk may only be used from its own thread
+            self.events.put(("timings", record))
+            return
+        self.plot_records.append(record)
+        summaries = [Profiler.summary(r) for r in self.plot_records]
+        self.status_text.set("\n".join(summaries))
+
+    def save_timings(self):
+        if not self.profiler.runs:
+            msg.showinfo("Save Timings", "Plot something first")
+            return
+        path = filedialog.asksaveasfilename(
+            defaultextension=".json", filetypes=[("JSON", "*.json")]
+        )
+        if path:
+            self.profiler.to_json(path)
+
     def tool_tips(self, input_frame):
 
         # Info logo image
@@ -226,8 +324,9 @@ class Visualisation(Page):
                 "+The DC current in Amperes flowing through the circular loop.\n+When"
                 " the current increases (absolute value),\n the magnetic field strength"
                 " increases too.\n+I<0: the direction which the current flows"
-                " changes,\n intended for AC simulation but Tkinter only produces"
-                " static Mayavi scenes.\n+For I=0 you get a WARNING."
+                " changes.\n+AC Animation renders one period of 1 Hz currents of"
+                " amplitude I,\n a quarter period out of phase between coils.\n+For"
+                " I=0 you get a WARNING."
             ),
             delay=0,
         )
@@ -251,17 +350,237 @@ class Visualisation(Page):
         return subprocess.Popen("a-doc.pdf", shell=True)
 
     def plot_field(self):
-        if self.cb.get() == "line":
-            plot = MagneticField()
-            return plot.line_el(float(self.e_R.get()), float(self.e_I.get()))
-        elif self.cb.get() == "plane":
-            plot = MagneticField()
-            return plot.plane_el(float(self.e_R.get()), float(self.e_I.get()))
-        elif self.cb.get() == "sphere":
-            plot = MagneticField()
-            return plot.sphere_el(float(self.e_R.get()), float(self.e_I.get()))
+        seedtype = self.cb.get()
+        if seedtype not in ("sphere", "plane", "line"):
+            return
+        radius, current = float(self.e_R.get()), float(self.e_I.get())
+
+        self.set_busy(True)
+        self.progress["value"] = 0
+        self.plot_records = []
+        self.levels_shown = 0
+        self.plot_error = None
+        self.status_text.set("Computing the field...")
+        self.cancel_event = threading.Event()
+        threading.Thread(
+            target=self.compute_field,
+            args=(radius, current, self.cancel_event),
+            daemon=True,
+        ).start()
+        self.after_idle(self.init_rendering)
+        self.after(50, self.poll_events, seedtype, radius, current)
+
+    def compute_field(self, radius, current, cancel):
+        """Worker thread: compute the field level by level and post each"""
+        try:
+            self.plot.set_coils(radius, current)
+            levels = len(self.plot.levels())
+            with self.profiler.run("compute_field", radius=radius, current=current):
+                for level in range(levels):
+                    B = self.plot.compute_field(
+                        radius,
+                        current,
+                        progress=lambda done, total, level=level: self.events.put(
+                            ("progress", (level + done / total) / levels)
+                        ),
+                        cancel=cancel,
+                        level=level,
+                    )
+                    self.events.put(("level", B))
+        except ComputationCancelled:
+            self.events.put(("cancelled", None))
+        except Exception as e:
+            self.events.put(("error", e))
         else:
+            self.events.put(("done", None))
+
+    def poll_events(self, seedtype, radius, current):
+        while True:
+            try:
+                event, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event == "progress":
+                self.progress["value"] = value
+            elif event == "timings":
+                self.show_timings(value)
+            elif event == "level":
+                if self.plot_error is None:
+                    self.show_level(value, seedtype, radius, current)
+            else:
+                if self.plot_error is not None:
+                    event, value = "error", self.plot_error
+                self.finish_plot(event, value, seedtype, radius, current)
+                return
+        self.after(50, self.poll_events, seedtype, radius, current)
+
+    def show_level(self, B, seedtype, radius, current):
+        """Show a finished level, the coarsest one replaces the last plot"""
+        # Mayavi has to update the scene on the Tk (main) thread
+        try:
+            if self.levels_shown == 0:
+                self.plot.update_scene(radius, current, seedtype, B=B)
+            else:
+                self.plot.swap_field(self.plot.objs, B)
+        except Exception as e:
+            # Stop the worker, its terminal event then reports the error
+            self.plot_error = e
+            self.cancel_event.set()
+            return
+        self.levels_shown += 1
+        n = B.shape[1]
+        self.status_text.set(f"Showing {n}x{n}x{n} points, refining...")
+
+    def set_busy(self, busy):
+        """Plots and animations both use `self.plot`, run one at a time"""
+        state = "disabled" if busy else "!disabled"
+        self.b_plot.state([state])
+        self.b_animate.state([state])
+        self.b_cancel.state(["!disabled" if busy else "disabled"])
+
+    def finish_plot(self, event, value, seedtype, radius, current):
+        self.set_busy(False)
+        self.cancel_event = None
+        if event == "cancelled":
+            self.progress["value"] = 0
+            # Keep the coarser level on display, if one was finished
+            if self.levels_shown:
+                self.status_text.set("Cancelled, showing a coarser grid")
+            else:
+                self.status_text.set("Cancelled")
+        elif event == "error":
+            self.progress["value"] = 0
+            self.status_text.set("Failed")
+            msg.showerror("Magnetic Field Visualiser", str(value))
+        else:
+            self.progress["value"] = 1
+
+    def animate(self):
+        output = filedialog.askdirectory(title="Directory for the frames")
+        if not output:
+            return
+        radius, current = float(self.e_R.get()), float(self.e_I.get())
+        self.plot.set_coils(radius, current)
+        waveforms = [
+            Waveform(coil.current, frequency=1.0, phase=i * math.pi / 2)
+            for i, coil in enumerate(self.plot.get_coils())
+        ]
+
+        self.set_busy(True)
+        self.progress["value"] = 0
+        self.plot_records = []
+        self.status_text.set("Computing the unit fields...")
+        self.cancel_event = threading.Event()
+        threading.Thread(
+            target=self.compute_unit_fields,
+            args=(radius, self.cancel_event),
+            daemon=True,
+        ).start()
+        self.after_idle(self.init_rendering)
+        self.after(50, self.poll_animation, output, waveforms, self.cb.get())
+
+    def compute_unit_fields(self, radius, cancel):
+        """Worker thread: compute the unit field of every coil and post them"""
+        try:
+            with self.profiler.run("unit_fields", radius=radius):
+                unit = self.plot.unit_fields(
+                    radius,
+                    progress=lambda done, total: self.events.put(
+                        ("progress", done / total)
+                    ),
+                    cancel=cancel,
+                )
+        except ComputationCancelled:
+            self.events.put(("cancelled", None))
+        except Exception as e:
+            self.events.put(("error", e))
+        else:
+            self.events.put(("unit_fields", unit))
+
+    def poll_animation(self, output, waveforms, seedtype):
+        while True:
+            try:
+                event, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if event == "progress":
+                self.progress["value"] = value
+            elif event == "timings":
+                self.show_timings(value)
+            elif event == "unit_fields":
+                frames = self.plot.render_frames(
+                    value, waveforms, output, seedtype=seedtype
+                )
+                count = len(frame_times(waveforms))
+                self.progress["value"] = 0
+                # One frame per Tk step, so the window stays responsive
+                self.after(1, self.render_frame, frames, 0, count, output)
+                return
+            else:
+                self.finish_animation(event, value, output, 0)
+                return
+        self.after(50, self.poll_animation, output, waveforms, seedtype)
+
+    def render_frame(self, frames, done, count, output):
+        if self.cancel_event.is_set():
+            frames.close()
+            self.finish_animation("cancelled", None, output, done)
+            return
+        try:
+            next(frames)
+        except StopIteration:
+            self.finish_animation("done", None, output, done)
+            return
+        except Exception as e:
+            frames.close()
+            self.finish_animation("error", e, output, done)
+            return
+        done += 1
+        self.progress["value"] = done / count
+        self.status_text.set(f"Rendering frame {done}/{count}...")
+        self.after(1, self.render_frame, frames, done, count, output)
+
+    def finish_animation(self, event, value, output, frames):
+        self.set_busy(False)
+        self.cancel_event = None
+        if event == "cancelled":
+            self.progress["value"] = 0
+            self.status_text.set(f"Cancelled, {frames} frames written to {output}")
+        elif event == "error":
+            self.progress["value"] = 0
+            self.status_text.set("Failed")
+            msg.showerror("AC Animation", str(value))
+        else:
+            self.progress["value"] = 1
+            self.status_text.set(f"{frames} frames written to {output}")
+
+    def init_rendering(self):
+        """Import Mayavi and set up rendering, while a worker computes
+
+        Mayavi and pyface bring up Qt, which has to happen on the Tk thread
+        and blocks it for a few seconds, so it is left for the first Plot or
+        Animate instead of freezing the parameter entry.
+        """
+        if mayavi_loaded():
             return
+        status = self.status_text.get()
+        self.status_text.set("Loading Mayavi...")
+        self.update_idletasks()
+        # A failed import or render context is reported by the first plot
+        try:
+            init_render_context()
+        except Exception:
+            pass
+        self.status_text.set(status)
+
+    def process_events(self):
+        MagneticField.process_events()
+        self.after(20, self.process_events)
+
+    def cancel_plot(self):
+        if self.cancel_event is not None:
+            self.cancel_event.set()
+            self.status_text.set("Cancelling...")
 
     @staticmethod
     def validate(value_if_allowed):
@@ -280,7 +599,7 @@ if __name__ == "__main__":
 
     root = tk.Tk()
     root.title("Magnetic Field Visualiser")
-    root.wm_geometry("550x460")
+    root.wm_geometry("550x640")
 
     # Set the theme
     root.tk.call("source", "themes/sun-valley/sun-valley.tcl")
@@ -0,0 +1,203 @@
+"""Far-field multipole expansion of coaxial current loops
+
+Outside the smallest sphere around a centre on the axis that contains the
+windings, the field of coaxial loops is the gradient of an axisymmetric
+scalar potential, a sum of zonal solid harmonics::
+
+    Phi = sum_l a_l F_l,  F_l = P_l(cos t) / r^(l + 1)
+
+The coefficients follow from expanding the exact on-axis field of a loop of
+radius R at axial offset z0, pi I R^2 / (R^2 + (z - z0)^2)^(3/2) in the units
+of `magnetic_field_single_coil`, with the Gegenbauer generating function::
+
+    a_l = pi I R^2 C^(3/2)_(l-1)(z0 / d) d^(l - 1) / (l + 1),  d^2 = R^2 + z0^2
+
+so the coefficients of all loops of a coaxial group add up to a single
+expansion, and the field follows from recurrences of F_l, which cost a
+fixed number of array operations per degree instead of two elliptic
+integrals per point and loop. The truncation error has a closed form bound
+(`AxialMultipole.error_bound`), which turns an error tolerance into the
+radius beyond which the expansion is used, see the "multipole" engine of
+`field_compute`. Run `python multipole.py` to check the bound against the
+exact field.
+"""
+from typing import Sequence, Tuple
+import numpy as np
+from scipy import special
+
+# Highest degree l of the default expansion
+MULTIPOLE_DEGREE = 10
+
+
+class AxialMultipole(object):
+    def __init__(
+        self,
+        loops: Sequence[Tuple[float, float, float]],
+        degree: int = MULTIPOLE_DEGREE,
+    ) -> None:
+        """Truncated exterior expansion of a group of coaxial loops
+
+        The expansion centre is placed midway between the outermost loops,
+        which for mirror symmetric groups (e.g. Helmholtz pairs) cancels
+        every even degree.
+
+        Args:
+            loops (Sequence[Tuple[float, float, float]]): axial offset,
+                radius and current of every loop, offsets along a common
+                axis line
+            degree (int, optional): highest degree l. Defaults to
+                `MULTIPOLE_DEGREE`.
+        """
+        offsets, radii, currents = (np.array(v, dtype=float) for v in zip(*loops))
+        self.degree = degree
+        self.centre = (offsets.min() + offsets.max()) / 2
+        z0 = offsets - self.centre
+        self.distances = np.hypot(radii, z0)
+        # pi |I| R^2 of every loop, the scale of its dipole moment
+        self.moments = np.pi * np.abs(currents) * radii ** 2
+
+        # a_l of the whole group, a_0 = 0 as there are no magnetic charges
+        self.coefficients = np.zeros(degree + 1)
+        l = np.arange(1, degree + 1)
+        for z, R, I, d in zip(z0, radii, currents, self.distances):
+            C = special.eval_gegenbauer(l - 1, 1.5, z / d)
+            self.coefficients[1:] += np.pi * I * R ** 2 * C * d ** (l - 1) / (l + 1)
+
+    @property
+    def convergence_radius(self) -> float:
+        """Distance from the centre beyond which the series converges"""
+        return float(self.distances.max())
+
+    def error_bound(self, r: float) -> float:
+        """Truncation error bound of |B| at distance `r` from the centre
+
+        With |C^(3/2)_n| <= (n + 1)(n + 2) / 2, |P_l| <= 1 and
+        |sin t P_l'| <= l (l + 1) / 2, the degree l term of a loop is at most
+        pi |I| R^2 / r^3 w_l y^(l - 1) with y = d / r and
+        w_l = l (l + 1) (l + 2) / 4. The ratio of consecutive terms,
+        (l + 3) / l y, decreases with l, so the omitted degrees are bounded
+        by a geometric series.
+
+        Returns:
+            float: bound in field units, inf where it does not hold
+        """
+        L = self.degree
+        y = self.distances / r
+        q = (L + 4) / (L + 1)
+        if np.any(q * y >= 1):
+            return np.inf
+        w = (L + 1) * (L + 2) * (L + 3) / 4
+        tail = self.moments / r ** 3 * w * y ** L / (1 - q * y)
+        return float(tail.sum())
+
+    def radius_for(self, error: float) -> float:
+        """Smallest distance from the centre with `error_bound` <= `error`"""
+        if error <= 0:
+            return np.inf
+        # The bound decreases monotonically with r, bisect once bracketed
+        lo = self.convergence_radius * (self.degree + 4) / (self.degree + 1)
+        hi = 2 * lo
+        while self.error_bound(hi) > error:
+            lo, hi = hi, 2 * hi
+        for _ in range(60):
+            mid = (lo + hi) / 2
+            if self.error_bound(mid) <= error:
+                hi = mid
+            else:
+                lo = mid
+        return hi
+
+    def field(
+        self, t: np.ndarray, r2: np.ndarray, block: int = 16384
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Field of the expansion, only valid beyond `convergence_radius`
+
+        Uses the recurrences of the solid harmonics, with h = 1 / r^2::
+
+            (n + 1) F_{n+1} = (2n + 1) t h F_n - n h F_{n-1}
+            D_{n+1} = h (D_{n-1} + (2n + 1) F_n),  D_n = P_n'(cos t) / r^(n + 2)
+
+        and dF_l/dz = -(l + 1) F_{l+1}, dF_l/drho = -rho D_{l+1}. The points
+        are processed in cache-sized blocks, as `elliptic.ellipke` does.
+
+        Args:
+            t (np.ndarray): 1D axial distances from the expansion centre
+            r2 (np.ndarray): 1D squared distances from the expansion centre
+            block (int, optional): points per block. Defaults to 16384.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: the axial component B_axis and
+            B_rho / rho, which turns the radial vector (not unit vector) from
+            the axis into the radial component without dividing by rho
+        """
+        t, r2 = np.asarray(t), np.asarray(r2)
+        B_axis = np.empty_like(r2)
+        B_rho = np.empty_like(r2)
+        a = self.coefficients
+        h, tau, F_prev, F, D_prev, D, tmp = np.empty((7, min(block, r2.size)), r2.dtype)
+        for i in range(0, r2.size, block):
+            n = min(block, r2.size - i)
+            hi, taui, Fp, Fi, Dp, Di, tmpi = (
+                buf[:n] for buf in (h, tau, F_prev, F, D_prev, D, tmp)
+            )
+            Ba, Br = B_axis[i : i + n], B_rho[i : i + n]
+
+            np.divide(1, r2[i : i + n], out=hi)
+            np.multiply(t[i : i + n], hi, out=taui)
+            np.sqrt(hi, out=Fp)  # F_0
+            np.multiply(taui, Fp, out=Fi)  # F_1
+            Dp.fill(0)  # D_0
+            np.multiply(hi, Fp, out=Di)  # D_1
+            Ba.fill(0)
+            Br.fill(0)
+            for l in range(1, self.degree + 1):
+                # D_{l+1}, overwriting D_{l-1}
+                np.multiply(Fi, 2 * l + 1, out=tmpi)
+                Dp += tmpi
+                Dp *= hi
+                # F_{l+1}, overwriting F_{l-1}
+                Fp *= hi
+                Fp *= -l / (l + 1)
+                np.multiply(taui, Fi, out=tmpi)
+                tmpi *= (2 * l + 1) / (l + 1)
+                Fp += tmpi
+                Fp, Fi, Dp, Di = Fi, Fp, Di, Dp
+                if a[l] == 0:
+                    continue
+                np.multiply(Fi, a[l] * (l + 1), out=tmpi)
+                Ba += tmpi
+                np.multiply(Di, a[l], out=tmpi)
+                Br += tmpi
+        return B_axis, B_rho
+
+
+if __name__ == "__main__":
+    from field_compute import Coil, CoilSet, coil_pair, maxwell
+
+    rng = np.random.default_rng(0)
+    setups = {
+        "loop": [Coil(1.0, 1.0)],
+        "pair": coil_pair(1.0, 1.0),
+        "maxwell": maxwell(1.0, 1.0),
+    }
+    for name, coils in setups.items():
+        multipole = AxialMultipole([(c.centre[2], c.radius, c.current) for c in coils])
+        scale = max(np.pi * abs(c.current) / c.radius for c in coils)
+        for tol in (1e-2, 1e-3, 1e-5):
+            r_far = multipole.radius_for(tol * scale)
+            # Random points on and beyond the far-field sphere
+            r = r_far * (1 + 2 * rng.random(100_000))
+            theta = np.arccos(rng.uniform(-1, 1, r.size))
+            phi = rng.uniform(0, 2 * np.pi, r.size)
+            x, y = r * np.sin(theta) * np.cos(phi), r * np.sin(theta) * np.sin(phi)
+            t = r * np.cos(theta)
+            B = CoilSet(coils).field(x, y, t + multipole.centre)
+            B_axis, B_rho = multipole.field(t, r ** 2)
+            error = np.sqrt(
+                (B[0] - B_rho * x) ** 2 + (B[1] - B_rho * y) ** 2 + (B[2] - B_axis) ** 2
+            )
+            print(
+                f"{name}, tol {tol:.0e}: r > {r_far:.2f} R, max error"
+                f" {error.max() / scale:.2e},"
+                f" bound {multipole.error_bound(r_far) / scale:.2e} of the peak field"
+            )
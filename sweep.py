@@ -0,0 +1,395 @@
+"""Parallel parameter sweeps with a resumable on-disk store
+
+Runs every combination of coil radius, separation and current of a
+configuration across a process pool and stores, for each configuration,
+homogeneity metrics of the field in a central region and optionally the
+field on the grid::
+
+    python sweep.py --radius 0.5:2:16 --separation 0.5:2:16 -o sweep
+
+Values are either lists or `start:stop:num` ranges as in `np.linspace`.
+
+The configurations are split into chunks, each chunk is written by the
+worker that computed it as a `.npz` file of metrics that only appears once
+the chunk is complete (written to a temporary file first), so an
+interrupted sweep picks up where it stopped by running the same command
+again. The fields of a chunk are computed straight into a memory-mapped
+`.npy` file next to it, from which single fields are read back without
+loading the rest of the chunk.
+"""
+import argparse
+import inspect
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional, Sequence
+import numpy as np
+
+from field_compute import CONFIGURATIONS, CoilSet, Grid, compute_field, field_at_points
+
+# Bump when a change alters the stored results
+SWEEP_VERSION = 2
+
+METRICS = ("B0", "max_deviation", "rms_deviation")
+
+
+def parameter_grid(**values: Sequence[float]) -> List[Dict[str, float]]:
+    """Every combination of the given parameter values
+
+    Example:
+        parameter_grid(radius=[1, 2], current=[1]) gives
+        [{"radius": 1, "current": 1}, {"radius": 2, "current": 1}]
+    """
+    names = list(values)
+    return [
+        dict(zip(names, combination))
+        for combination in itertools.product(*(values[n] for n in names))
+    ]
+
+
+def homogeneity(
+    coils, radius: float, region: float = 0.25, points: int = 21
+) -> Dict[str, float]:
+    """Uniformity of |B| within a sphere around the origin
+
+    Args:
+        coils: coils contributing to the field
+        radius (float): coil radius the region is relative to
+        region (float, optional): radius of the sphere in units of `radius`.
+            Defaults to 0.25.
+        points (int, optional): sample points per axis of the region.
+            Defaults to 21.
+
+    Returns:
+        Dict[str, float]: |B| at the centre, and the largest and the RMS
+        deviation of |B| relative to it within the sphere
+    """
+    r = region * radius
+    n = points * 1j
+    x, y, z = np.ogrid[-r:r:n, -r:r:n, -r:r:n]
+    coilset = CoilSet(coils)
+    B = coilset.field(x, y, z)
+    norm = np.sqrt((B ** 2).sum(axis=0))[x ** 2 + y ** 2 + z ** 2 <= r ** 2]
+    B0 = float(np.linalg.norm(field_at_points(coils, np.zeros((1, 3)))))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        deviation = np.abs(norm - B0) / B0
+    return {
+        "B0": B0,
+        "max_deviation": float(deviation.max()),
+        "rms_deviation": float(np.sqrt(np.mean(deviation ** 2))),
+    }
+
+
+class Sweep(object):
+    def __init__(
+        self,
+        directory: str,
+        parameters: Dict[str, Sequence[float]],
+        configuration: str = "pair",
+        extent: Optional[float] = None,
+        spacing=32j,
+        region: float = 0.25,
+        save_fields: bool = True,
+        dtype=np.float32,
+        chunk_size: int = 16,
+    ) -> None:
+        """Parameter sweep stored in `directory`
+
+        Args:
+            directory (str): store directory, created if needed
+            parameters (Dict[str, Sequence[float]]): values of "radius",
+                "current" and of the extra arguments of the configuration,
+                e.g. "separation" for "pair"
+            configuration (str, optional): key of `CONFIGURATIONS`.
+                Defaults to "pair".
+            extent (float, optional): half-width of the common grid of all
+                fields. Defaults to 4 times the largest radius.
+            spacing (optional): grid spacing, see `Grid`. Defaults to 32j.
+            region (float, optional): radius of the homogeneity region in
+                units of the coil radius. Defaults to 0.25.
+            save_fields (bool, optional): store the fields, not only the
+                metrics. Defaults to True.
+            dtype (optional): precision of the stored fields.
+                Defaults to np.float32.
+            chunk_size (int, optional): configurations per chunk file.
+                Defaults to 16.
+        """
+        self.directory = directory
+        self.parameters = {k: [float(v) for v in vs] for k, vs in parameters.items()}
+        self.configuration = configuration
+        if extent is None:
+            extent = 4 * max(self.parameters.get("radius", [1.0]))
+        self.extent = float(extent)
+        self.spacing = spacing
+        self.region = region
+        self.save_fields = save_fields
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.configurations = parameter_grid(**self.parameters)
+
+        # Catch parameters the configuration does not take before any work
+        if configuration not in CONFIGURATIONS:
+            raise ValueError(f"Unknown configuration: {configuration}")
+        signature = inspect.signature(CONFIGURATIONS[configuration])
+        unknown = sorted(set(self.parameters) - set(signature.parameters))
+        if unknown:
+            raise ValueError(
+                f"The {configuration} configuration does not take"
+                f" {', '.join(unknown)}"
+            )
+        if "radius" not in self.parameters:
+            raise ValueError("The sweep needs radius values")
+
+    @property
+    def settings(self) -> dict:
+        spacing = complex(self.spacing)
+        return {
+            "version": SWEEP_VERSION,
+            "parameters": self.parameters,
+            "configuration": self.configuration,
+            "extent": self.extent,
+            "spacing": [spacing.real, spacing.imag],
+            "region": self.region,
+            "save_fields": self.save_fields,
+            "dtype": self.dtype.name,
+            "chunk_size": self.chunk_size,
+        }
+
+    @property
+    def grid(self) -> Grid:
+        L = self.extent
+        return Grid(L, L, L, self.spacing)
+
+    @property
+    def n_chunks(self) -> int:
+        return -(-len(self.configurations) // self.chunk_size)
+
+    def chunk_path(self, chunk: int) -> str:
+        return os.path.join(self.directory, f"chunk_{chunk:05d}.npz")
+
+    def fields_path(self, chunk: int) -> str:
+        return os.path.join(self.directory, f"chunk_{chunk:05d}_B.npy")
+
+    def pending(self) -> List[int]:
+        """Chunks that have not been written yet"""
+        return [
+            c for c in range(self.n_chunks) if not os.path.exists(self.chunk_path(c))
+        ]
+
+    def _prepare(self) -> None:
+        """Create the store, or check that it belongs to this sweep"""
+        os.makedirs(self.directory, exist_ok=True)
+        # Partial chunks of an interrupted run
+        for name in os.listdir(self.directory):
+            if name.endswith((".tmp.npz", ".tmp.npy")):
+                os.remove(os.path.join(self.directory, name))
+        manifest = os.path.join(self.directory, "manifest.json")
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                if json.load(f) != self.settings:
+                    raise ValueError(
+                        f"{self.directory} holds a sweep with different settings"
+                    )
+            return
+        tmp = f"{manifest}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.settings, f, indent=2)
+        os.replace(tmp, manifest)
+
+    def run(self, workers: Optional[int] = None, verbose: bool = True) -> None:
+        """Compute every pending chunk on a process pool
+
+        Args:
+            workers (int, optional): processes, None uses all cores.
+                Defaults to None.
+            verbose (bool, optional): print progress. Defaults to True.
+        """
+        self._prepare()
+        pending = self.pending()
+        if verbose:
+            done = self.n_chunks - len(pending)
+            print(f"{done}/{self.n_chunks} chunks already done")
+        if not pending:
+            return
+
+        start = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_run_chunk, self, c) for c in pending]
+            for i, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if verbose:
+                    elapsed = time.perf_counter() - start
+                    eta = elapsed / i * (len(pending) - i)
+                    print(f"{i}/{len(pending)} chunks, {eta:.0f} s left", flush=True)
+
+    def compute_chunk(self, chunk: int) -> None:
+        """Compute and write a single chunk"""
+        index = range(
+            chunk * self.chunk_size,
+            min((chunk + 1) * self.chunk_size, len(self.configurations)),
+        )
+        grid = self.grid
+        metrics = {m: np.empty(len(index)) for m in METRICS}
+        fields = None
+        if self.save_fields:
+            fields_tmp = f"{self.fields_path(chunk)}.{os.getpid()}.tmp.npy"
+            fields = np.lib.format.open_memmap(
+                fields_tmp, "w+", self.dtype, (len(index), 3) + grid.shape
+            )
+
+        try:
+            for i, k in enumerate(index):
+                params = dict(self.configurations[k])
+                radius, current = params.pop("radius"), params.pop("current", 1.0)
+                coils = CONFIGURATIONS[self.configuration](radius, current, **params)
+                for name, value in homogeneity(coils, radius, self.region).items():
+                    metrics[name][i] = value
+                if fields is not None:
+                    compute_field(
+                        coils, grid, dtype=self.dtype, out=fields[i], symmetry=True
+                    )
+        except BaseException:
+            if fields is not None:
+                del fields
+                os.remove(fields_tmp)
+            raise
+
+        if fields is not None:
+            fields.flush()
+            del fields
+            # Before the metrics, whose file marks the chunk as complete
+            os.replace(fields_tmp, self.fields_path(chunk))
+
+        arrays = {"index": np.array(index), **metrics}
+        path = self.chunk_path(chunk)
+        tmp = f"{path}.{os.getpid()}.tmp.npz"
+        try:
+            np.savez(tmp, **arrays)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        os.replace(tmp, path)
+
+    def results(self) -> Dict[str, np.ndarray]:
+        """Parameters and metrics of the configurations computed so far
+
+        Returns:
+            Dict[str, np.ndarray]: "index" of the configuration, a column per
+            parameter and per metric
+        """
+        columns = {"index": []}
+        columns.update({m: [] for m in METRICS})
+        for chunk in range(self.n_chunks):
+            path = self.chunk_path(chunk)
+            if not os.path.exists(path):
+                continue
+            with np.load(path) as data:
+                for name in columns:
+                    columns[name].append(data[name])
+        results = {
+            k: np.concatenate(v) if v else np.empty(0) for k, v in columns.items()
+        }
+        index = results["index"] = results["index"].astype(int)
+        for name in self.parameters:
+            values = [self.configurations[k][name] for k in index]
+            results[name] = np.array(values, dtype=float)
+        return results
+
+    def field(self, k: int) -> np.ndarray:
+        """Stored field of configuration `k`
+
+        A read-only memory map of the chunk's fields, so only the pages of
+        field `k` are read, and only when they are accessed.
+        """
+        chunk, i = divmod(k, self.chunk_size)
+        return np.load(self.fields_path(chunk), mmap_mode="r")[i]
+
+
+def _run_chunk(sweep: Sweep, chunk: int) -> None:
+    # Module level so that it can be sent to the worker processes
+    sweep.compute_chunk(chunk)
+
+
+def _values(text: str) -> List[float]:
+    """Parse "a,b,c" lists and "start:stop:num" ranges"""
+    if ":" in text:
+        start, stop, num = text.split(":")
+        return list(np.linspace(float(start), float(stop), int(num)))
+    return [float(v) for v in text.split(",")]
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Sweep coil parameters and store fields and homogeneity"
+    )
+    parser.add_argument(
+        "--configuration",
+        choices=sorted(CONFIGURATIONS),
+        default="pair",
+        help="coil configuration",
+    )
+    parser.add_argument("--radius", type=_values, default=[1.0], help="coil radii")
+    parser.add_argument("--current", type=_values, default=[1.0], help="currents")
+    parser.add_argument(
+        "--separation",
+        type=_values,
+        default=None,
+        help="distances between the coils of a pair",
+    )
+    parser.add_argument(
+        "--spacing", type=int, default=32, help="number of points per axis"
+    )
+    parser.add_argument(
+        "--extent",
+        type=float,
+        default=None,
+        help="half-width of the grid, defaults to 4 times the largest radius",
+    )
+    parser.add_argument(
+        "--region",
+        type=float,
+        default=0.25,
+        help="radius of the homogeneity region in coil radii",
+    )
+    parser.add_argument(
+        "--metrics-only", action="store_true", help="do not store the fields"
+    )
+    parser.add_argument("--chunk-size", type=int, default=16)
+    parser.add_argument(
+        "--workers", type=int, default=0, help="processes, 0 uses all cores"
+    )
+    parser.add_argument("-o", "--output", default="sweep", help="store directory")
+    args = parser.parse_args(argv)
+
+    parameters = {"radius": args.radius, "current": args.current}
+    if args.separation is not None:
+        parameters["separation"] = args.separation
+    try:
+        sweep = Sweep(
+            args.output,
+            parameters,
+            configuration=args.configuration,
+            extent=args.extent,
+            spacing=args.spacing * 1j,
+            region=args.region,
+            save_fields=not args.metrics_only,
+            chunk_size=args.chunk_size,
+        )
+    except ValueError as e:
+        parser.error(str(e))
+    sweep.run(workers=args.workers or None)
+
+    results = sweep.results()
+    best = int(np.argmin(results["max_deviation"]))
+    print(
+        "Most homogeneous: "
+        + ", ".join(f"{name}={results[name][best]:.4g}" for name in parameters)
+        + f", max deviation {results['max_deviation'][best]:.3e}"
+    )
+
+
+if __name__ == "__main__":
+    main()
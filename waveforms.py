@@ -0,0 +1,311 @@
+"""AC currents: per-coil waveforms and fields by superposition
+
+B is linear in the currents, so once the field of every coil carrying a
+unit current has been computed, the field for any set of currents is the
+linear combination
+
+    B(t) = sum_i I_i(t) B_i
+
+which `UnitFields.frame` evaluates as a single matrix-vector product into a
+preallocated buffer. Animation frames therefore never recompute a field,
+see `MagneticField.animate` for the rendering and `main` for the command
+line entry point::
+
+    python waveforms.py --configuration pair --phase 0 90 -o frames
+"""
+import argparse
+import math
+import threading
+from fractions import Fraction
+from typing import Callable, List, Optional, Sequence
+import numpy as np
+
+from field_compute import (
+    CONFIGURATIONS,
+    Coil,
+    Grid,
+    compute_field,
+    point_order_field,
+)
+
+# Longest common period, in periods of the lowest frequency, `frame_times`
+# uses by default
+MAX_PERIODS = 100
+
+
+class Waveform(object):
+    def __init__(
+        self,
+        amplitude: float = 1.0,
+        frequency: float = 0.0,
+        phase: float = 0.0,
+        offset: float = 0.0,
+    ) -> None:
+        """Sinusoidal current I(t) = offset + amplitude cos(2 pi f t + phase)
+
+        Args:
+            amplitude (float, optional): peak current. Defaults to 1.0.
+            frequency (float, optional): frequency in Hz, 0 is a DC current
+                of `amplitude`. Defaults to 0.0.
+            phase (float, optional): phase in radians. Defaults to 0.0.
+            offset (float, optional): DC offset. Defaults to 0.0.
+        """
+        self.amplitude = amplitude
+        self.frequency = frequency
+        self.phase = phase
+        self.offset = offset
+
+    def __call__(self, t: float) -> float:
+        return self.offset + self.amplitude * math.cos(
+            2 * math.pi * self.frequency * t + self.phase
+        )
+
+    def __repr__(self) -> str:
+        return (
+            f"Waveform(amplitude={self.amplitude}, frequency={self.frequency},"
+            f" phase={self.phase}, offset={self.offset})"
+        )
+
+
+def common_period(frequencies: Sequence[float]) -> Optional[float]:
+    """Shortest time after which all frequencies repeat, 1 / gcd(frequencies)
+
+    Returns:
+        Optional[float]: the common period, None if a frequency is not a
+        ratio of small integers (denominator at most 1000)
+    """
+    numerator, denominator = 0, 1
+    for f in frequencies:
+        fraction = Fraction(f).limit_denominator(1000)
+        if not math.isclose(float(fraction), f, rel_tol=1e-9):
+            return None
+        numerator = math.gcd(numerator, fraction.numerator)
+        denominator = denominator * fraction.denominator // math.gcd(
+            denominator, fraction.denominator
+        )
+    # gcd of p_i / q_i is gcd(p_i) / lcm(q_i)
+    return denominator / numerator
+
+
+def frame_times(
+    waveforms: Sequence[Waveform], fps: float = 25.0, duration: Optional[float] = None
+) -> np.ndarray:
+    """Times of the frames of an animation
+
+    Args:
+        waveforms (Sequence[Waveform]): current of every coil
+        fps (float, optional): frames per second. Defaults to 25.0.
+        duration (float, optional): length of the animation in seconds.
+            Defaults to the common period of the non-zero frequencies, e.g.
+            1 s for 2 Hz and 3 Hz, or a single frame if all currents are DC.
+            Frequencies without a common period of at most `MAX_PERIODS`
+            periods of the lowest one fall back to one period of the lowest.
+
+    Returns:
+        np.ndarray: frame times, without the end point so that an animation
+        of a whole common period loops seamlessly
+    """
+    if duration is None:
+        frequencies = [abs(w.frequency) for w in waveforms if w.frequency != 0]
+        if not frequencies:
+            return np.zeros(1)
+        duration = common_period(frequencies)
+        if duration is None or duration * min(frequencies) > MAX_PERIODS:
+            duration = 1 / min(frequencies)
+    n = max(1, int(round(duration * fps)))
+    return np.arange(n) / fps
+
+
+class UnitFields(object):
+    def __init__(
+        self,
+        coils: Sequence[Coil],
+        grid: Grid,
+        dtype=np.float64,
+        elliptic: str = "scipy",
+        workers: Optional[int] = 1,
+        progress: Optional[Callable[[int, int], None]] = None,
+        cancel: Optional[threading.Event] = None,
+        wire_cutoff: float = 0.0,
+    ) -> None:
+        """Fields of every coil carrying a unit current, computed once
+
+        Memory is one field per coil. The fields are laid out in VTK point
+        order, see `point_order_field`, so the frames can be handed to VTK
+        without copying.
+
+        Args:
+            coils (Sequence[Coil]): coils, their currents are ignored
+            grid (Grid): grid to evaluate the fields on
+            dtype (optional): precision of the fields. Defaults to np.float64.
+            elliptic (str, optional): elliptic integral backend.
+                Defaults to "scipy".
+            workers (int, optional): threads per field, see `compute_field`.
+                Defaults to 1.
+            progress (Callable[[int, int], None], optional): called with the
+                number of finished and total slabs of all coils.
+                Defaults to None.
+            cancel (threading.Event, optional): set to stop the computation
+                with `ComputationCancelled`. Defaults to None.
+            wire_cutoff (float, optional): wire thickness as a fraction of
+                the radius, see `compute_field`. Defaults to 0.
+        """
+        self.coils = list(coils)
+        self.grid = grid
+        self.dtype = np.dtype(dtype)
+        nx, ny, nz = grid.shape
+        # (coil, nz, ny, nx, component), i.e. a point order field per coil
+        self.fields = np.empty((len(self.coils), nz, ny, nx, 3), dtype=dtype)
+        for i, (field, coil) in enumerate(zip(self.fields, self.coils)):
+            coil_progress = None
+            if progress is not None:
+
+                def coil_progress(done: int, total: int, i: int = i) -> None:
+                    progress(i * total + done, len(self.coils) * total)
+
+            compute_field(
+                [Coil(coil.radius, 1.0, coil.centre, coil.axis)],
+                grid,
+                dtype=dtype,
+                out=field.T,
+                workers=workers,
+                elliptic=elliptic,
+                symmetry=True,
+                progress=coil_progress,
+                cancel=cancel,
+                wire_cutoff=wire_cutoff,
+            )
+        self._matrix = self.fields.reshape(len(self.coils), -1)
+
+    def currents(self, waveforms: Sequence[Waveform], t: float) -> np.ndarray:
+        if len(waveforms) != len(self.coils):
+            raise ValueError(
+                f"Expected {len(self.coils)} waveforms, got {len(waveforms)}"
+            )
+        return np.array([w(t) for w in waveforms], dtype=self.dtype)
+
+    def combine(
+        self, currents: Sequence[float], out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """Field for the given current of every coil
+
+        Args:
+            currents (Sequence[float]): current of every coil
+            out (np.ndarray, optional): array from `point_order_field` to
+                write the field to. Defaults to a new one.
+
+        Returns:
+            np.ndarray: B with shape (3, nx, ny, nz), in point order
+        """
+        if out is None:
+            out = point_order_field(self.grid.shape, self.dtype)
+        # A single pass over the unit fields (BLAS gemv), writing in place
+        currents = np.asarray(currents, dtype=self.dtype)
+        np.dot(currents, self._matrix, out=out.T.reshape(-1))
+        return out
+
+    def frame(
+        self,
+        waveforms: Sequence[Waveform],
+        t: float,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """Field at time `t`, see `combine`"""
+        return self.combine(self.currents(waveforms, t), out)
+
+    def peak(self, waveforms: Sequence[Waveform]) -> float:
+        """Upper bound of |B| over all times, for a fixed colour range"""
+        norms = np.sqrt((self.fields ** 2).sum(axis=-1)).reshape(len(self.coils), -1)
+        bounds = [abs(w.offset) + abs(w.amplitude) for w in waveforms]
+        return float(np.max(np.dot(bounds, norms)))
+
+
+def main(argv: Optional[Sequence[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Render an animation of the field of AC coil currents"
+    )
+    parser.add_argument(
+        "--configuration",
+        choices=sorted(CONFIGURATIONS),
+        default="pair",
+        help="coil configuration",
+    )
+    parser.add_argument("--radius", type=float, default=1.0, help="coil radius R")
+    parser.add_argument(
+        "--amplitude",
+        type=float,
+        nargs="+",
+        default=None,
+        help="current amplitude of every coil, defaults to the coil currents",
+    )
+    parser.add_argument(
+        "--frequency",
+        type=float,
+        nargs="+",
+        default=[1.0],
+        help="frequency in Hz of every coil, or one for all",
+    )
+    parser.add_argument(
+        "--phase",
+        type=float,
+        nargs="+",
+        default=[0.0],
+        help="phase in degrees of every coil, or one for all",
+    )
+    parser.add_argument(
+        "--spacing", type=int, default=50, help="number of points per axis"
+    )
+    parser.add_argument("--fps", type=float, default=25.0, help="frames per second")
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=None,
+        help="seconds, defaults to the common period of the frequencies",
+    )
+    parser.add_argument(
+        "--seedtype", choices=("sphere", "plane", "line"), default="sphere"
+    )
+    parser.add_argument(
+        "--video", default=None, help="also encode the frames with ffmpeg"
+    )
+    parser.add_argument(
+        "-o", "--output", default="frames", help="directory of the PNG frames"
+    )
+    args = parser.parse_args(argv)
+
+    coils = CONFIGURATIONS[args.configuration](args.radius, 1.0)
+
+    def per_coil(values: List[float]) -> List[float]:
+        if len(values) == 1:
+            return values * len(coils)
+        if len(values) != len(coils):
+            parser.error(f"expected 1 or {len(coils)} values, got {len(values)}")
+        return values
+
+    amplitudes = per_coil(args.amplitude or [c.current for c in coils])
+    waveforms = [
+        Waveform(a, f, math.radians(p))
+        for a, f, p in zip(
+            amplitudes, per_coil(args.frequency), per_coil(args.phase)
+        )
+    ]
+
+    from magnetic_field import MagneticField
+
+    plot = MagneticField(
+        args.radius, 1.0, spacing=args.spacing * 1j, configuration=args.configuration
+    )
+    paths = plot.animate(
+        args.radius,
+        waveforms,
+        output=args.output,
+        fps=args.fps,
+        duration=args.duration,
+        seedtype=args.seedtype,
+        video=args.video,
+    )
+    print(f"{len(paths)} frames written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()